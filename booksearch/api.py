@@ -2,22 +2,32 @@
 """
 Wrapper around the ISBNdb API which provides search functionality.
 """
-import re
 import json
 import hmac
 import time
+import Queue
 import base64
+import marshal
 import urllib
-import urllib2
 import hashlib
+import urlparse
 import threading
+import traceback
 from functools import wraps
+from contextlib import contextmanager
+from collections import namedtuple, OrderedDict
 from lxml import objectify, etree
 from abc import ABCMeta, abstractmethod
 
-from werkzeug.contrib.cache import SimpleCache
-
+import pool
+import health
+import limits
+import metrics
+import tracing
 import settings
+from cache import create_cache, SingleFlight, SingleFlightTimeout
+from transport import create_transport, Cancel, TransportError, \
+    TransportTimeout
 
 
 class APIRequestError(Exception):
@@ -35,102 +45,571 @@ class GoogleBooksRequestError(APIRequestError):
     pass
 
 
+class APITimeoutError(APIRequestError):
+    "Raised when a call didn't answer in time or the deadline expired"
+    pass
+
+
+class APIThrottledError(APIRequestError):
+    "Raised when upstream asks to slow down (HTTP 429 or 503)"
+    pass
+
+
+class APIUnavailableError(APIThrottledError):
+    "Raised without calling upstream while its circuit breaker is open"
+    pass
+
+
+# Compact results of the requests, these are cached instead of the responses
+ResultPage = namedtuple('ResultPage', 'items total_results page_size '
+                                      'page_number')
+Volume = namedtuple('Volume', 'id isbns fields')
+VolumeList = namedtuple('VolumeList', 'total volumes')
+
+# Instrumentation of the upstream calls and the stages around them
+UPSTREAM_SECONDS = metrics.histogram(
+    'booksearch_upstream_seconds',
+    'Upstream HTTP calls by provider and outcome')
+UPSTREAM_REJECTED = metrics.counter(
+    'booksearch_upstream_rejected_total',
+    'Upstream calls not made by provider and reason')
+UPSTREAM_HEDGED = metrics.counter(
+    'booksearch_upstream_hedged_total',
+    'Duplicated slow upstream calls by provider')
+CALL_SECONDS = metrics.histogram(
+    'booksearch_call_seconds',
+    'Searches and lookups by provider and call, cache misses only')
+CACHE_REQUESTS = metrics.counter(
+    'booksearch_cache_requests_total',
+    'Cache lookups by provider and result (hit, stale or miss)')
+CACHE_SECONDS = metrics.histogram(
+    'booksearch_cache_seconds',
+    'Cache operations by operation (get or set)')
+PARSE_SECONDS = metrics.histogram(
+    'booksearch_parse_seconds',
+    'Parsing of the responses by provider and stage')
+DISPATCH_SECONDS = metrics.histogram(
+    'booksearch_dispatch_wait_seconds',
+    'Waits for dispatched requests to finish')
+
+# Parameters which don't change the response, left out of the cache keys
+CREDENTIALS = ('key', 'access_key', 'AWSAccessKeyId', 'AssociateTag',
+               'Signature', 'Timestamp')
+
+
+def clean_isbn(isbn):
+    "Removes all non-isbn characters"
+    clean = "".join([c for c in isbn if c.isdigit()])
+    if isbn[-1].upper() == 'X':
+        clean += 'X'
+    return clean
+
+
+def to_isbn10(isbn):
+    """Returns the ISBN-10 of an ISBN-10 or ISBN-13
+    None if it isn't a valid isbn or has no ISBN-10 (979 prefix)
+
+    >>> to_isbn10('978-0-553-80457-7')
+    '055380457X'
+    """
+    isbn13 = to_isbn13(isbn)
+    if isbn13 is None or not isbn13.startswith('978'):
+        return None
+    check = -sum((10 - i) * int(c) for i, c in enumerate(isbn13[3:12])) % 11
+    return isbn13[3:12] + ('X' if check == 10 else str(check))
+
+
+def _quote(value):
+    "Url-encodes a value as RFC 3986, as Amazon expects"
+    return urllib.quote(str(value), safe='-_.~')
+
+
+def to_isbn13(isbn):
+    """Returns the ISBN-13 of an ISBN-10 or ISBN-13
+    None if it isn't a valid isbn (wrong length or check digit)
+
+    >>> to_isbn13('0-553-80457-X')
+    '9780553804577'
+    """
+    if not isbn:
+        return None
+    clean = clean_isbn(isbn)
+
+    if len(clean) == 10 and clean[:9].isdigit():
+        check = sum((10 - i) * (10 if c == 'X' else int(c))
+                    for i, c in enumerate(clean)) % 11
+        if check:
+            return None
+        clean = '978' + clean[:9]
+        clean += str(-sum((3 if i % 2 else 1) * int(c)
+                          for i, c in enumerate(clean)) % 10)
+        return clean
+
+    if len(clean) == 13 and clean.isdigit():
+        if sum((3 if i % 2 else 1) * int(c) for i, c in enumerate(clean)) % 10:
+            return None
+        return clean
+
+    return None
+
+
+def canonical(value):
+    """Returns a representation of value which doesn't depend on dict
+    ordering or object addresses, leaving out the CREDENTIALS
+    """
+    if isinstance(value, dict):
+        return sorted((str(k), canonical(v)) for k, v in value.iteritems()
+                      if k not in CREDENTIALS)
+    if isinstance(value, (list, tuple)):
+        return [canonical(v) for v in value]
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, type):
+        return value.__name__
+    if callable(value):
+        name = getattr(value, '__name__', '<lambda>')
+        # Anonymous functions are told apart only by their identity
+        return repr(value) if name == '<lambda>' else name
+    return value
+
+
+def redact(url):
+    "Returns url without the CREDENTIALS in its query"
+    parts = urlparse.urlsplit(url)
+    query = [(k, v) for k, v in urlparse.parse_qsl(parts.query, True)
+             if k not in CREDENTIALS]
+    return urlparse.urlunsplit(parts._replace(query=urllib.urlencode(query)))
+
+
+def cache_key(fn, args, kwargs):
+    """Deterministic key of a call to a cached function
+    The key is namespaced by the provider and class of the calling request
+    The timeout doesn't change the outcome, it's left out of the key
+    """
+    cls, args = args[0], args[1:]
+    kwargs = dict((k, v) for k, v in kwargs.iteritems() if k != 'timeout')
+    key = json.dumps([cls.PROVIDER, cls.__name__, fn.__name__,
+                      canonical(args), canonical(kwargs)],
+                     separators=(',', ':'))
+    return '{0}:{1}'.format(cls.PROVIDER, hashlib.sha1(key).hexdigest())
+
+
+class CacheEntry(namedtuple('CacheEntry', 'value error created ttl')):
+    """Cached outcome of a call, either its value or its error message
+    Entries with results are kept CACHE_GRACE_TIME after their ttl to be
+    served stale, see graced
+    """
+
+    __slots__ = ()
+
+    @property
+    def age(self):
+        return time.time() - self.created
+
+    @property
+    def fresh(self):
+        return self.age < self.ttl
+
+    @property
+    def graced(self):
+        "Whether it's served stale while refreshed, only if it has results"
+        return self.error is None and not is_empty(self.value)
+
+    def result(self):
+        "Returns the value or raises the error of the call"
+        if self.error is not None:
+            raise APIRequestError(self.error)
+        return self.value
+
+
+def is_empty(data):
+    "Returns if the outcome of a call means there were no results"
+    if isinstance(data, VolumeList):
+        return data.total == 0
+    if isinstance(data, (ResultPage, BookPage)):
+        return not data.total_results
+    return not data
+
+
 def cached(fn):
     """Decorator to cache function outcomes
     It's better to cache data which has been already processed
+
+    Concurrent calls missing the cache with the same key are coalesced,
+    only the first one is made and the rest wait for its outcome
+
+    Calls without results and failed calls (but timeouts and throttling)
+    are cached too, for CACHE_EMPTY_TIME and CACHE_ERROR_TIME. Expired
+    entries with results are still served during CACHE_GRACE_TIME while
+    they are refreshed in background, the rest are missed
+
+    Functions must be classmethods of an APIRequest, see cache_key
     """
     @wraps(fn)
     def wrapper(*args, **kwargs):
-        cache_key = hashlib.sha1("{0}".format((args, kwargs))).hexdigest()
+        key = cache_key(fn, args, kwargs)
+
+        def fetch(kwargs):
+            # It may have been cached while joining the flight
+            with CACHE_SECONDS.time(operation='get'):
+                entry = APIRequest.cache.get(key)
+            if entry is not None and entry.fresh:
+                return entry
+
+            try:
+                with CALL_SECONDS.time(provider=provider, call=fn.__name__),\
+                        tracing.span(fn.__name__, provider=provider):
+                    data = fn(*args, **kwargs)
+            except (APITimeoutError, APIThrottledError):
+                raise
+            except APIRequestError, err:
+                entry = CacheEntry(None, str(err), time.time(),
+                                   settings.CACHE_ERROR_TIME)
+            else:
+                ttl = (settings.CACHE_EMPTY_TIME if is_empty(data)
+                       else settings.CACHE_TIME)
+                entry = CacheEntry(data, None, time.time(), ttl)
+
+            with CACHE_SECONDS.time(operation='set'):
+                APIRequest.cache.set(key, entry, entry.ttl +
+                                     (settings.CACHE_GRACE_TIME
+                                      if entry.graced else 0))
+            return entry
+
+        provider = args[0].PROVIDER
+        with CACHE_SECONDS.time(operation='get'):
+            entry = APIRequest.cache.get(key)
+        if entry is not None and not entry.fresh and not entry.graced:
+            entry = None  # expired errors and empty outcomes are fetched again
+        if entry is not None:
+            CACHE_REQUESTS.inc(provider=provider,
+                               result='hit' if entry.fresh else 'stale')
+            if not entry.fresh and not APIRequest.flights.busy(key):
+                # Serve it stale, the refresh may take its time
+                refresh_kwargs = dict(kwargs)
+                if 'timeout' in kwargs:
+                    refresh_kwargs['timeout'] = settings.HTTP_TIMEOUT
+                pool.get_pool('refresh').submit(APIRequest.flights.do,
+                                                key, fetch,
+                                                refresh_kwargs)
+            return entry.result()
+
+        CACHE_REQUESTS.inc(provider=provider, result='miss')
+        try:
+            entry = APIRequest.flights.do(key, fetch, kwargs,
+                                          wait_timeout=kwargs.get('timeout'))
+        except SingleFlightTimeout:
+            raise APITimeoutError('Timed out waiting for {0}'
+                                  .format(fn.__name__))
+        return entry.result()
 
-        data = APIRequest.cache.get(cache_key)
-        if data is not None:
-            return data
+    return wrapper
 
-        data = fn(*args, **kwargs)
 
-        APIRequest.cache.set(cache_key, data)
-        return data
+class Deadline(object):
+    """Latency budget shared by all the requests of a search
 
-    return wrapper
+    >>> deadline = Deadline(5)
+    >>> deadline.remaining()
+    4.999...
+    >>> Deadline().remaining() is None  # No limit
+    True
+    """
+
+    def __init__(self, seconds=None):
+        self.expires = None if seconds is None else time.time() + seconds
 
+    def remaining(self):
+        "Returns the seconds left or None if there is no limit"
+        if self.expires is not None:
+            return max(0, self.expires - time.time())
 
-class APIRequest(threading.Thread):
+    @property
+    def expired(self):
+        return self.remaining() == 0
+
+
+class APIRequest(object):
     """Basic XML GET request
     Abstract class. Derived classes must implement the get() method
     Queries cache their responses after being processed
-    Requests are threads so they can be used to perform asynchronous calls
+    Requests can be started and joined like threads to perform asynchronous
+    calls, they run in the worker pool of their PROVIDER
+
+    An optional Deadline limits the time spent on the request, any call
+    made after it expired fails straight away
     """
 
     __metaclass__ = ABCMeta
 
-    cache = SimpleCache(threshold=settings.CACHE_THRESHOLD,
-                        default_timeout=settings.CACHE_TIME)
+    cache = create_cache(settings.CACHE_BACKEND,
+                         default_timeout=settings.CACHE_TIME,
+                         **settings.CACHE_OPTIONS)
+
+    # Upstream calls in progress, keyed as the cache
+    flights = SingleFlight()
+
+    # Keep-alive connections shared by all the requests
+    transport = create_transport(settings.TRANSPORT,
+                                 size=settings.HTTP_POOL_SIZE,
+                                 sizes=settings.HTTP_POOL_SIZES,
+                                 ignore=CREDENTIALS,
+                                 **settings.TRANSPORT_OPTIONS)
+
+    # Name of the worker pool which runs this kind of requests
+    PROVIDER = 'default'
 
-    def __init__(self):
-        super(APIRequest, self).__init__()
-        self.setDaemon(True)  # Avoid zombie threads when exiting
+    def __init__(self, deadline=None):
         self.data = None
+        self.task = None
+        self.deadline = deadline or Deadline()
 
     @abstractmethod
     def get(self):
         return self
 
     def run(self):
-        "To be run as a thread"
-        self.get()
+        "To be run in a worker thread"
+        with tracing.span(type(self).__name__, **self.tags):
+            self.get()
+
+    @property
+    def tags(self):
+        "What the request is about, to tell it apart in the traces"
+        return {}
+
+    def start(self):
+        "Schedules the request in the worker pool of its provider"
+        self.task = pool.get_pool(self.PROVIDER).submit(self.run)
+
+    def join(self, timeout=None):
+        "Waits for a started request to finish"
+        if self.task is not None:
+            self.task.wait(timeout)
+
+    @property
+    def done(self):
+        "Returns if a started request has finished"
+        return self.task is not None and self.task.done
+
+    @property
+    def timeout(self):
+        """Seconds to wait for the next upstream call
+        raises APIRequestError if the deadline has already expired
+        """
+        remaining = self.deadline.remaining()
+        if remaining is None:
+            return settings.HTTP_TIMEOUT
+        if not remaining:
+            raise APITimeoutError('Deadline exceeded')
+        return min(remaining, settings.HTTP_TIMEOUT)
 
     @staticmethod
-    def distpach(requests):
-        "Convenience method for distpaching a list of request threads"
+    def distpach(requests, deadline=None):
+        """Convenience method for distpaching a list of requests
+        Stops waiting when the deadline expires, leaving the unfinished
+        requests without data
+        """
         for r in requests:
             r.start()
 
-        for r in requests:
-            r.join()
+        with DISPATCH_SECONDS.time():
+            pool.wait([r.task for r in requests],
+                      deadline.remaining() if deadline else None)
 
         return requests
 
     @classmethod
-    def distpach_data(cls, requests):
-        """Convenience method for distpaching a list of request threads
-        returns the data of each request
+    def distpach_data(cls, requests, deadline=None):
+        """Convenience method for distpaching a list of requests
+        returns the data of each request, None for the unfinished ones
         """
-        return [r.data for r in cls.distpach(requests)]
+        return [r.data if r.done else None
+                for r in cls.distpach(requests, deadline)]
+
+    @classmethod
+    def open(cls, url, param=None, timeout=None, kind=None):
+        """Fetchs a remote url using a GET request
+        kind names the sort of call, whose latencies are kept apart
+        """
+        if param:
+            url = "{url}?{params}".format(url=url,
+                                          params=urllib.urlencode(param))
+        with cls.limited(url, timeout, kind):
+            metrics.log('Request: {0}', url)
+            try:
+                if cls.PROVIDER in settings.HEDGE_PROVIDERS:
+                    return cls.hedged_get(url, timeout, kind)
+                return APIRequest.transport.get(url, timeout=timeout)
+            except TransportError, err:
+                raise APIRequest.error(url, err)
+
+    @classmethod
+    def hedged_get(cls, url, timeout=None, kind=None):
+        """Fetchs url in the calling thread and, if it takes longer than the
+        HEDGE_PERCENTILE of the latency of this kind of call to the provider,
+        a timer sends a duplicate request. The first successful answer is
+        taken and the other request cancelled. The duplicate is only sent if
+        the rate and concurrency limits allow it right away
+        raises TransportError if both fail
+        """
+        delay = health.get_breaker(cls.PROVIDER).percentile(
+            settings.HEDGE_PERCENTILE, kind)
+        if delay is None or (timeout is not None and delay >= timeout):
+            return APIRequest.transport.get(url, timeout=timeout)
+
+        limiter = limits.get_limiter(cls.PROVIDER)
+        primary, duplicate = Cancel(), Cancel()
+        answers = Queue.Queue()
+        lock = threading.Lock()
+        state = {'done': False, 'hedged': False}
+
+        def attempt():
+            try:
+                body = APIRequest.transport.get(url, timeout=timeout,
+                                                cancel=duplicate)
+            except TransportError, err:
+                answers.put((None, err))
+            else:
+                answers.put((body, None))
+                primary.cancel()
+            finally:
+                limiter.release()
+
+        def hedge():
+            with lock:
+                if state['done'] or not limiter.acquire(timeout=0):
+                    return
+                state['hedged'] = True
+            metrics.log('Hedged request: {0}', url)
+            UPSTREAM_HEDGED.inc(provider=cls.PROVIDER)
+            pool.get_pool('hedge').submit(attempt)
+
+        timer = pool.call_later(delay, hedge)
+        body, error = None, None
+        try:
+            body = APIRequest.transport.get(url, timeout=timeout,
+                                            cancel=primary)
+        except TransportError, err:
+            error = err
+        finally:
+            timer.cancel()
+            with lock:
+                state['done'] = True
+
+        if error is None:
+            duplicate.cancel()
+            return body
+        if state['hedged']:
+            answer, err = answers.get()
+            if err is None:
+                return answer
+        raise error
 
     @staticmethod
-    def open(url, param=None):
-        "Fetchs a remote url using a GET request"
+    def open_stream(url, param=None, timeout=None):
+        """Fetchs a remote url using a GET request
+        returns a file-like object to read the body while it's downloaded
+        The caller must hold the provider limits while reading, see limited
+        """
         if param:
             url = "{url}?{params}".format(url=url,
                                           params=urllib.urlencode(param))
-        print 'Request: {0}'.format(url)
+        metrics.log('Request: {0}', url)
         try:
-            return urllib2.urlopen(url).read()
-        except (urllib2.URLError, urllib2.HTTPError), err:
-            print 'Error on request: {0}'.format(url)
-            raise APIRequestError(err)
+            return APIRequest.transport.stream(url, timeout=timeout)
+        except TransportError, err:
+            raise APIRequest.error(url, err)
 
     @classmethod
-    @cached
-    def get_json(cls, url, param=None):
+    @contextmanager
+    def limited(cls, url, timeout=None, kind=None):
+        """Runs an upstream call within the rate and concurrency limits of
+        the PROVIDER, which learn from its latency and throttling errors
+        Its outcome is recorded by the circuit breaker of the PROVIDER, with
+        the kind of call, while open the call fails straight away with
+        APIUnavailableError
+        raises APITimeoutError if it has to wait longer than timeout
+        """
+        breaker = health.get_breaker(cls.PROVIDER)
+        if not breaker.allow():
+            metrics.log('Unavailable provider for request: {0}', url)
+            UPSTREAM_REJECTED.inc(provider=cls.PROVIDER, reason='unavailable')
+            raise APIUnavailableError('{0} is unavailable'
+                                      .format(cls.PROVIDER))
+
+        limiter = limits.get_limiter(cls.PROVIDER)
+        if not limiter.acquire(timeout):
+            breaker.release()
+            metrics.log('Rate limited request: {0}', url)
+            UPSTREAM_REJECTED.inc(provider=cls.PROVIDER, reason='rate_limited')
+            raise APITimeoutError('Rate limit of {0}'.format(cls.PROVIDER))
+
+        start, latency, throttled = time.time(), None, False
+        outcome = 'ok'
+        try:
+            with tracing.span(cls.PROVIDER, url=redact(url)):
+                yield
+            latency = time.time() - start
+            breaker.record(latency, kind=kind)
+        except APIThrottledError:
+            throttled, outcome = True, 'throttled'
+            breaker.release()
+            raise
+        except APIRequestError, err:
+            # Timeouts, network errors, server errors and garbage count
+            # against the provider, other HTTP errors are proper answers
+            status = getattr(err.args[0] if err.args else None, 'status', None)
+            if status is None or status >= 500:
+                breaker.record(time.time() - start, ok=False, kind=kind)
+            else:
+                breaker.record(time.time() - start, kind=kind)
+            outcome = ('timeout' if isinstance(err, APITimeoutError)
+                       else 'error')
+            raise
+        except BaseException:
+            outcome = 'error'
+            breaker.release()
+            raise
+        finally:
+            limiter.release(latency, throttled)
+            UPSTREAM_SECONDS.observe(time.time() - start,
+                                     provider=cls.PROVIDER, outcome=outcome)
+
+    @staticmethod
+    def error(url, err):
+        "Returns the APIRequestError for a TransportError"
+        if isinstance(err, TransportTimeout):
+            metrics.log('Timeout on request: {0}', url)
+            return APITimeoutError(err)
+        if err.status in (429, 503):
+            metrics.log('Throttled request: {0}', url)
+            return APIThrottledError(err)
+        metrics.log('Error on request: {0}', url)
+        return APIRequestError(err)
+
+    @classmethod
+    def get_json(cls, url, param=None, timeout=None, kind=None):
         """Fetch a remote url which returns a deserialized object
         raises APIRequestError on failure
         """
+        body = cls.open(url, param if param else {}, timeout, kind)
         try:
-            return json.loads(cls.open(url, param if param else {}))
+            with PARSE_SECONDS.time(provider=cls.PROVIDER, stage='json'):
+                return json.loads(body)
         except (TypeError, ValueError, OverflowError), err:
             raise APIRequestError(err)
 
     @classmethod
-    @cached
-    def get_xml(cls, url, param=None):
+    def get_xml(cls, url, param=None, timeout=None, kind=None):
         """Fetch a remote url and parse it's XML object into a DOM object
         returns an lxml.objectify object
         raises APIRequestError on failure
         """
+        body = cls.open(url, param if param else {}, timeout, kind)
         try:
-            return objectify.fromstring(cls.open(url, param if param else {}))
+            with PARSE_SECONDS.time(provider=cls.PROVIDER, stage='xml'):
+                return objectify.fromstring(body)
         except etree.XMLSyntaxError, err:
             raise APIRequestError(err)
 
@@ -238,140 +717,412 @@ class GoogleBooksRequest(APIRequest):
 
     """
 
+    PROVIDER = 'google'
     ACCESS_KEY = settings.GOOGLE_BOOKS_ACCESS_KEY
     BASE_URL = 'https://www.googleapis.com/books/v1/volumes'
-    RE_ISBN_10 = re.compile('^((\d|X)[ -]?){10}$')
-    RE_ISBN_13 = re.compile('^((\d|X)[ -]?){13}$')
 
     # Extracted data from the Google request
-    FIELDS = ('pageCount', 'averagRating', 'ratingsCount', 'imageLinks')
+    FIELDS = ('pageCount', 'averageRating', 'ratingsCount', 'imageLinks')
 
-    def __init__(self, isbn):
-        super(GoogleBooksRequest, self).__init__()
+    def __init__(self, isbn, volume_id=None, deadline=None):
+        """The isbn is searched as ISBN-13, raises GoogleBooksRequestError if
+        it's not a valid ISBN-10 or ISBN-13
+        volume_id skips the search when the Google id is already known
+        """
+        super(GoogleBooksRequest, self).__init__(deadline)
 
-        if not self.RE_ISBN_10.match(isbn) and not self.RE_ISBN_13.match(isbn):
+        isbn13 = to_isbn13(isbn)
+        if isbn13 is None:
             raise GoogleBooksRequestError('Invalid isbn "{0}"'.format(isbn))
 
+        self.isbn = isbn
+
         self.params_search = {
             'key': self.ACCESS_KEY,
-            'q': 'isbn:{0}'.format(self.clean_isbn(isbn)),
+            'q': 'isbn:{0}'.format(isbn13),
             'maxResults': 1
         }
+        self.volume_id = volume_id
 
-        # REST-like access for the item lookup
-        self.url_lookup = self.BASE_URL + '/{id}'
-        self.params_lookup = {
-            'key': self.ACCESS_KEY,
-        }
-
-        self.json = None
+    @property
+    def tags(self):
+        return {'isbn': self.isbn}
 
     def get(self):
         """Fetchs the request and initialize self.data
         data will be a dict with part of the info in the lookup response
         containing the fields in FIELDS:
+
+        data stays None if there was no answer in time or upstream is
+        throttling, so the book is reported as missing the data
         """
-        try:
-            if not self.json:
-                self.data = {}
+        if self.data is None:
+            data = {}
+            try:
+                self._lookup(data)
+            except (APITimeoutError, APIThrottledError):
+                data = None
+            except APIRequestError:
+                data = {}
+            # Set at once, readers may not wait for an unfinished request
+            self.data = data
 
-                # Perform the search
-                self.json = self.get_json(self.BASE_URL, self.params_search)
-                if not self.json or self.json['totalItems'] == 0:
-                    return self
+        return self
 
-                book_id = self.json['items'][0]['id']
+    def _lookup(self, data):
+        "Performs the search and the lookup filling the data dict"
+        book_id = self.volume_id
+        if book_id is None:
+            # Perform the search
+            result = self.search_volumes(self.params_search,
+                                         timeout=self.timeout)
+            if not result.volumes:
+                return
 
-                # Lookup the book
-                self.json = self.get_json(self.url_lookup.format(id=book_id),
-                                          self.params_lookup)
-                if not self.json or 'volumeInfo' not in self.json:
-                    return self
+            book_id = result.volumes[0].id
 
-                for field in self.FIELDS:
-                    self.data[field] = self.json['volumeInfo'].get(field)
-        except APIRequestError:
-            self.data = {}
+        # Lookup the book
+        data.update(self.lookup_volume(book_id, timeout=self.timeout))
+
+    @classmethod
+    @cached
+    def search_volumes(cls, params, timeout=None):
+        """Performs a search and returns it as a VolumeList
+        Only the id, the isbns and the FIELDS of each item are kept
+        """
+        response = cls.get_json(cls.BASE_URL, params, timeout=timeout,
+                                kind='search') or {}
+
+        volumes = []
+        for item in response.get('items', []):
+            info = item.get('volumeInfo', {})
+            isbns = tuple(identifier.get('identifier') for identifier
+                          in info.get('industryIdentifiers', []))
+            volumes.append(Volume(item['id'], isbns, cls.extract(info)))
+
+        return VolumeList(response.get('totalItems', 0), volumes)
+
+    @classmethod
+    @cached
+    def lookup_volume(cls, volume_id, timeout=None):
+        "Looks up a volume by id, returns the dict of its FIELDS"
+        response = cls.get_json('{0}/{1}'.format(cls.BASE_URL, volume_id),
+                                {'key': cls.ACCESS_KEY}, timeout=timeout,
+                                kind='lookup')
+        if not response or 'volumeInfo' not in response:
+            return {}
+
+        return cls.extract(response['volumeInfo'])
+
+    @classmethod
+    def extract(cls, volume_info):
+        "Returns a dict with the FIELDS in a volumeInfo, None if not present"
+        return dict((field, volume_info.get(field)) for field in cls.FIELDS)
+
+
+class GoogleBooksBatchRequest(APIRequest):
+    """Google Books lookup for a whole page of books
+
+    The isbns are combined in as few searches as possible
+    (`isbn:A OR isbn:B ...`) and the FIELDS are read straight from the
+    volumeInfo of each item in the search response.
+
+    A GoogleBooksRequest is only made as a fallback:
+        - lookup by volume id when a found item lacks some REQUIRED field
+        - search and lookup when the combined search failed or came back
+          truncated
+
+    data will be a dict isbn -> dict of FIELDS as in GoogleBooksRequest,
+    with None for the isbns still pending when the deadline expired.
+    Isbns are searched as ISBN-13 so a book listed both as ISBN-10 and
+    ISBN-13 is fetched once, invalid isbns are never searched
+
+    >>> req = GoogleBooksBatchRequest(['0553804578', '0131103628']).get()
+    >>> req.data['0131103628']['pageCount']
+    272
+    """
+
+    PROVIDER = 'google'
+    FIELDS = GoogleBooksRequest.FIELDS
+
+    # Fields worth a lookup if missing in the search response
+    REQUIRED = ('pageCount', 'imageLinks')
+
+    # Isbns combined per search and max items per search response
+    BATCH_SIZE = settings.GOOGLE_BATCH_SIZE
+    MAX_RESULTS = 40
+
+    def __init__(self, isbns, deadline=None):
+        super(GoogleBooksBatchRequest, self).__init__(deadline)
+        self.isbns = list(isbns)
+
+    @property
+    def tags(self):
+        return {'isbns': len(self.isbns)}
+
+    def get(self):
+        "Fetchs the request and initialize self.data"
+        if self.data is None:
+            self.data = dict(self.stream())
 
         return self
 
-    def clean_isbn(self, isbn):
-        "Removes all non-isbn characters"
-        clean = "".join([c for c in isbn if c.isdigit()])
-        if isbn[-1].upper() == 'X':
-            clean += 'X'
-        return clean
+    def stream(self):
+        """Yields (isbn, fields) for each isbn as soon as its data is known
+        The batches are searched in parallel and the fallbacks started as
+        soon as their batch answers. (isbn, None) is yielded for the isbns
+        still pending when the deadline expires
+        """
+        isbns = {}  # ISBN-13 -> isbns as given
+        for isbn in self.isbns:
+            isbns.setdefault(to_isbn13(isbn), []).append(isbn)
+        for isbn in isbns.pop(None, ()):
+            yield isbn, {}  # invalid isbns are never searched
+
+        finished = Queue.Queue()
+        google = pool.get_pool(self.PROVIDER)
+
+        def report(fn, arg, isbns):
+            "Runs fn(arg) in a worker, the outcome is queued even if it fails"
+            try:
+                finished.put(fn(arg))
+            except Exception:
+                traceback.print_exc()
+                finished.put((dict.fromkeys(isbns), None))
+
+        def lookup(req):
+            "Fallback request, its (found, None) completes the search data"
+            return {req.isbn: req.get().data}, None
+
+        valid = sorted(isbns)
+        for i in range(0, len(valid), self.BATCH_SIZE):
+            batch = valid[i:i + self.BATCH_SIZE]
+            google.submit(report, self._search, batch, batch)
+
+        # The deadline wakes the loop with None, timed waits are polled
+        remaining = self.deadline.remaining()
+        timer = (None if remaining is None
+                 else pool.call_later(remaining, finished.put, None))
+
+        data = {}
+        pending = set(valid)
+        while pending:
+            outcome = finished.get()
+            if outcome is None:
+                break
+
+            found, fallback = outcome
+            if fallback is None:
+                for isbn13, fields in found.items():
+                    complete = dict(data.get(isbn13) or {})
+                    complete.update((field, value) for field, value
+                                    in (fields or {}).iteritems()
+                                    if value is not None)
+                    found[isbn13] = (complete if complete or fields is not None
+                                     else None)
+                fallback = ()
+
+            data.update(found)
+            for req in fallback:
+                google.submit(report, lookup, req, [req.isbn])
+            waiting = set(req.isbn for req in fallback)
+
+            for isbn13, fields in found.iteritems():
+                if isbn13 in waiting or isbn13 not in pending:
+                    continue
+                pending.discard(isbn13)
+                for isbn in isbns[isbn13]:
+                    yield isbn, fields
+
+        if timer is not None:
+            timer.cancel()
+
+        # out of time, keep whatever the batch search found
+        for isbn13 in pending:
+            for isbn in isbns[isbn13]:
+                yield isbn, data.get(isbn13) or None
+
+    def _search(self, isbns):
+        """Searches a batch of ISBN-13 at once
+        Returns (found, fallback), the dict isbn -> fields of the results and
+        the GoogleBooksRequest needed for the incomplete ones
+        """
+        params = {
+            'key': GoogleBooksRequest.ACCESS_KEY,
+            'q': ' OR '.join('isbn:{0}'.format(isbn) for isbn in isbns),
+            'maxResults': self.MAX_RESULTS
+        }
+        wanted = set(isbns)
+
+        try:
+            result = GoogleBooksRequest.search_volumes(params,
+                                                       timeout=self.timeout)
+        except (APIThrottledError, APITimeoutError):
+            return dict.fromkeys(isbns), []  # pending, don't insist
+        except APIRequestError:
+            return {}, [GoogleBooksRequest(isbn, deadline=self.deadline)
+                        for isbn in isbns]
+
+        volumes = {}
+        for volume in result.volumes:
+            for identifier in volume.isbns:
+                isbn = to_isbn13(identifier)
+                if isbn in wanted and isbn not in volumes:
+                    volumes[isbn] = volume
+
+        truncated = result.total > len(result.volumes)
+        found, requests = {}, []
+        for isbn in isbns:
+            volume = volumes.get(isbn)
+            if volume is None:
+                if truncated:
+                    requests.append(GoogleBooksRequest(isbn,
+                                                       deadline=self.deadline))
+                else:
+                    found[isbn] = {}
+                continue
+
+            found[isbn] = dict(volume.fields)
+            if any(found[isbn].get(field) is None for field in self.REQUIRED):
+                requests.append(GoogleBooksRequest(isbn, volume_id=volume.id,
+                                                   deadline=self.deadline))
+
+        return found, requests
 
 
 class AmazonRequest(APIRequest):
     """Amazon API Book lookup implementation
 
-    Only for book covers
+    Only for book covers, of up to MAX_ITEMS books in a single ItemLookup
+    call asking only for the Images. The ASIN of a book is its ISBN-10,
+    so books with an ISBN-13 only (979 prefix) can't be looked up.
+
+    data will be a dict isbn -> dict of image urls as the imageLinks of
+    GoogleBooksRequest, or None if the book wasn't found. It's empty if
+    Amazon didn't answer in time or throttled the lookup
+
+    >>> req = AmazonRequest(['0553804578', '9780131103627']).get()
+    >>> req.data['0553804578']['thumbnail']
+    'http://ecx.images-amazon.com/images/I/51T8hH...._SL160_.jpg'
     """
 
+    PROVIDER = 'amazon'
     ACCESS_KEY = settings.AMAZON_ACCESS_KEY
     SECRET_ACCESS_KEY = settings.AMAZON_SECRET_ACCESS_KEY
     HOST = 'webservices.amazon.es'
     PATH = '/onca/xml'
     BASE_URL = 'http://{host}{path}'.format(host=HOST, path=PATH)
+    MAX_ITEMS = 10
+
+    # Parameters common to all the lookups
+    PARAMS = {
+        'Service': 'AWSECommerceService',
+        'AWSAccessKeyId': ACCESS_KEY,
+        'Operation': 'ItemLookup',
+        'IdType': 'ASIN',
+        'ResponseGroup': 'Images',
+        'AssociateTag': '',
+    }
+
+    # Image sizes as the imageLinks of Google Books
+    IMAGES = (('SmallImage', 'smallThumbnail'), ('MediumImage', 'thumbnail'),
+              ('LargeImage', 'large'))
+
+    # Signed queries are reused this long (Amazon accepts 15 min old ones)
+    SIGNATURE_TTL = 300
+    SIGNATURES_SIZE = 1000
+
+    # Prefix of every string to sign and keyed HMAC ready to be copied
+    _to_sign = "\n".join(["GET", HOST, PATH, ""])
+    _hmac = hmac.new(key=SECRET_ACCESS_KEY, digestmod=hashlib.sha256)
+    _signatures = OrderedDict()
+    _signatures_lock = threading.Lock()
+
+    def __init__(self, isbns, deadline=None):
+        super(AmazonRequest, self).__init__(deadline)
+        self.isbns = list(isbns)
 
-    def __init__(self, isbn):
-        super(AmazonRequest, self).__init__()
-
-        self.params = {
-            'Service': 'AWSECommerceService',
-            'AWSAccessKeyId': self.ACCESS_KEY,
-            'Operation': 'ItemSearch',
-            'AssociateTag': '',
-            'SearchIndex': 'Books',
-            'Power': 'ISBN:{0}'.format(isbn),
-            'Timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ',
-                                       time.gmtime())
-                      }
-        self.dom = None
-        self.urls = None
+    @property
+    def tags(self):
+        return {'isbns': len(self.isbns)}
 
     def get(self):
-        """Fetchs the request and initialize self.data
-        with a list of urls from smaller to bigger
-        """
-        if self.dom is None:
-            params = urllib.urlencode(self.params)
-            params += '&Signature={0}'.format(self._sign_request(self.params))
-            self.dom = self.get_xml(self.BASE_URL + '?' + params)
+        "Fetchs the request and initialize self.data"
+        if self.data is None:
+            asins = dict((isbn, to_isbn10(isbn)) for isbn in self.isbns)
+            valid = tuple(sorted(set(asin for asin in asins.itervalues()
+                                     if asin is not None)))
+            images = {}
+            if valid:
+                try:
+                    images = self.lookup_images(valid, timeout=self.timeout)
+                except (APITimeoutError, APIThrottledError):
+                    self.data = {}  # unknown, not missing in Amazon
+                    return self
+                except APIRequestError:
+                    pass
+
+            self.data = dict((isbn, images.get(asin))
+                             for isbn, asin in asins.iteritems())
 
         return self
 
-    def _sign_request(self, params):
+    @classmethod
+    @cached
+    def lookup_images(cls, asins, timeout=None):
+        """Looks up the images of up to MAX_ITEMS asins
+        returns a dict asin -> dict of image urls for the ones found
         """
-        Signs the request's parameters
+        params = dict(cls.PARAMS, ItemId=','.join(asins))
+        dom = cls.get_xml(cls.BASE_URL + '?' + cls.sign(params),
+                          timeout=timeout)
+
+        ns = dom.tag[:dom.tag.find('}') + 1]  # {namespace} of the response
+        images = {}
+        for item in dom.iter(ns + 'Item'):
+            links = {}
+            for tag, name in cls.IMAGES:
+                url = item.findtext('{0}{1}/{0}URL'.format(ns, tag))
+                if url:
+                    links[name] = url
+            if links:
+                images[item.findtext(ns + 'ASIN')] = links
+        return images
 
-        Get the canonical url and calculate the SHA1-256 over the base64
-        The canonical url is all parameters sorted
-        and url-encoded
+    @classmethod
+    def sign(cls, params):
+        """Returns the query string of params, timestamped and signed
 
-        Returns the signed parameters
+        The canonical query is all parameters sorted and url-encoded,
+        the signature the base64 of its HMAC-SHA256 after the method,
+        host and path. The HMAC key is only processed once and the signed
+        queries are reused for SIGNATURE_TTL seconds
 
         From the Amazon WS documentation:
             http://docs.amazonwebservices.com/AWSECommerceService
                    /latest/DG/rest-signature.html
         """
-        if 'Signature' in params:
-            del params['Signature']
+        memo = tuple(sorted(params.items()))
+        with cls._signatures_lock:
+            signed = cls._signatures.get(memo)
+            if signed and time.time() - signed[0] < cls.SIGNATURE_TTL:
+                return signed[1]
 
-        # Prepend this lines to the sorted and escaped url
-        canonical = "\n".join(["GET", self.HOST, self.PATH,
-                               urllib.urlencode(sorted(params.items()))])
+        now = time.time()
+        params = dict(params, Timestamp=time.strftime('%Y-%m-%dT%H:%M:%SZ',
+                                                      time.gmtime(now)))
+        query = '&'.join('{0}={1}'.format(_quote(key), _quote(value))
+                         for key, value in sorted(params.items()))
 
-        # Calculate the HMAC-SHA256
-        signature = hmac.new(key=self.SECRET_ACCESS_KEY, msg=canonical,
-                             digestmod=hashlib.sha256).digest()
+        digest = cls._hmac.copy()
+        digest.update(cls._to_sign + query)
+        query += '&Signature=' + _quote(base64.b64encode(digest.digest()))
 
-        # Base64 the hash
-        signature = base64.b64encode(signature)
-
-        # Escape the + and - in the url
-        return urllib.quote(signature)
+        with cls._signatures_lock:
+            cls._signatures[memo] = (now, query)
+            while len(cls._signatures) > cls.SIGNATURES_SIZE:
+                cls._signatures.popitem(last=False)
+        return query
 
 
 class ISBNdbRequest(APIRequest):
@@ -402,26 +1153,32 @@ class ISBNdbRequest(APIRequest):
     and one extra argument 'results' asking for more information:
 
     >>> req = (ISBNdbRequest(collection='authors', field='name',\
-      value='conrad', trans=lambda dom: dom.Details.get('first_name'),\
+      value='conrad', trans=lambda dom: dom.find('Details').get('first_name'),\
       results='details').get())
     >>> req.data[:7]
     ['Conrad', 'Betty', 'Colin', 'Conrad', 'Alan', 'Conrad', 'Conrad']
     """
 
+    PROVIDER = 'isbndb'
     ACCESS_KEY = settings.ISBNdb_ACCESS_KEY
     BASE_URL = 'http://isbndb.com/api'
     COLLECTIONS = ('books', 'subjects', 'categories', 'authors', 'publisher')
+    PAGE_SIZE = 10
 
-    def __init__(self, collection, field, value, page=1, trans=None, **kwargs):
+    def __init__(self, collection, field, value, page=1, trans=None,
+                 deadline=None, **kwargs):
         """Request to a given collection filtering by field.
         Page ask for the nth page in the result
         trans is a function which will transform each element in result
           the function should take a single argument, the dom data element of
-          the result
+          the result. Its outcome is cached (not the dom) so it should
+          return plain data and be a long lived function, as it's part of
+          the cache key
+        deadline is the Deadline shared with the rest of the search
 
         Extra request parameters can be added through kwargs
         """
-        super(ISBNdbRequest, self).__init__()
+        super(ISBNdbRequest, self).__init__(deadline)
         if collection not in self.COLLECTIONS:
             raise ISBNdbRequestError("Unkown collection '{0}'"
                                      .format(collection))
@@ -432,51 +1189,124 @@ class ISBNdbRequest(APIRequest):
                        'value1': value, 'page_number': page}
         self.params.update(kwargs)
         self.trans = trans
-        self.dom = None         # dom root element
-        self.list_dom = None    # dom of the list of result elements
+        self.result = None      # ResultPage with the transformed elements
+
+    @property
+    def tags(self):
+        return {'field': self.params['index1'], 'value': self.params['value1'],
+                'page': self.params['page_number']}
 
     def get(self):
         "Fetchs and returns the data"
-        if self.dom is None:
-            self.dom = self.get_xml(self.url, self.params)
+        if self.result is None:
+            self.result = self.get_page(self.url, self.params, self.trans,
+                                        timeout=self.timeout)
 
-            if self.dom.getchildren():
-                self.list_dom = self.dom.getchildren()[0]
-                self.data = map(self.trans, self.list_dom.getchildren())
+            if self.result is not None:
+                self.data = map(self.load, self.result.items)
 
         return self
 
+    def load(self, item):
+        "Builds the final data from each cached item, the item by default"
+        return item
+
+    @classmethod
+    @cached
+    def get_page(cls, url, param=None, trans=None, timeout=None):
+        """Fetch a page of results and transform its elements
+        returns a ResultPage, or None if the response has no list of results
+        raises APIRequestError on failure
+        """
+        elements = cls.stream_page(url, param, trans, timeout=timeout)
+        attrs = next(elements, None)
+        if attrs is None:
+            return None
+
+        return cls.make_page(items=list(elements),
+                             total_results=int(attrs.get('total_results')),
+                             page_size=int(attrs.get('page_size')),
+                             page_number=int(attrs.get('page_number')))
+
+    @classmethod
+    def stream_page(cls, url, param=None, trans=None, timeout=None):
+        """Fetch a page of results parsing it while it's downloaded
+        Yields the attributes of the list of results (dict) and then each
+        transformed element as soon as it's complete. Elements are freed
+        once transformed so the whole tree is never kept in memory
+        raises APIRequestError on failure
+        """
+        trans = trans or (lambda element: element)
+        with cls.limited(url, timeout):
+            response = cls.open_stream(url, param if param else {}, timeout)
+            try:
+                depth = 0
+                for event, element in etree.iterparse(response,
+                                                      events=('start', 'end')):
+                    if event == 'start':
+                        depth += 1
+                        if depth == 2:  # <BookList total_results=...>
+                            yield dict(element.attrib)
+                        continue
+
+                    if depth == 3:  # <BookData> inside the list
+                        with PARSE_SECONDS.time(provider=cls.PROVIDER,
+                                                stage='transform'):
+                            item = trans(element)
+                        yield item
+                        element.clear()
+                        while element.getprevious() is not None:
+                            del element.getparent()[0]
+                    depth -= 1
+            except etree.XMLSyntaxError, err:
+                raise APIRequestError(err)
+            except TransportError, err:
+                raise cls.error(url, err)
+            finally:
+                response.close()
+
+    @staticmethod
+    def make_page(**kwargs):
+        "Returns the container of a page of results, a ResultPage"
+        return ResultPage(**kwargs)
+
     @property
     def total_results(self):
         "Returns the total number of results for the API call (listed 10)"
-        if self.list_dom is not None:
-            return int(self.list_dom.get('total_results'))
+        if self.result is not None:
+            return self.result.total_results
 
     @property
     def page_size(self):
         "Returns the current number of results in the call (max 10)"
-        if self.list_dom is not None:
-            return int(self.list_dom.get('page_size'))
+        if self.result is not None:
+            return self.result.page_size
 
     @property
     def page_number(self):
         "Returns the current page for the results"
-        if self.list_dom is not None:
-            return int(self.list_dom.get('page_number'))
+        if self.result is not None:
+            return self.result.page_number
 
     @property
     def total_pages(self):
         "Returns the number of total pages"
-        if self.list_dom is not None:
+        if self.result is not None:
             total_results = self.total_results
-            return total_results // 10 + (1 if total_results % 10 else 0)
+            return (total_results // self.PAGE_SIZE +
+                    (1 if total_results % self.PAGE_SIZE else 0))
 
     @property
     def more_pages(self):
         "Returns if the current page is not the last page"
-        if self.list_dom is not None:
+        if self.result is not None:
             return bool(self.total_pages != self.page_number)
 
+    @property
+    def fetched(self):
+        "Returns when the page was fetched from upstream, if known"
+        return getattr(self.result, 'fetched', None)
+
 
 class BookRequest(ISBNdbRequest):
     """BookRequest ISBNdb API
@@ -520,50 +1350,131 @@ class BookRequest(ISBNdbRequest):
     FIELDS = ('isbn', 'title', 'combined', 'full', 'book_id', 'person_id',
               'publisher_id', 'subject_id')
 
-    def __init__(self, field, value, page=1):
-        "The request filtered by field using value and retrieves the page 1 "
+    def __init__(self, field, value, page=1, enrich=True, deadline=None):
+        """The request filtered by field using value and retrieves the page 1
+        With enrich=False the books are not completed with Google data,
+        so callers can enrich_books() just the ones they will show
+        """
         if field not in self.FIELDS:
             raise ISBNdbRequestError("Unkown field '{0}' for collection "
                                 "'books'".format(field))
         super(BookRequest, self).__init__(collection='books', field=field,
                                           value=value, page=page,
-                                          trans=self._parse, results='details')
+                                          trans=self._parse, deadline=deadline,
+                                          results='details')
+        self.enrich = enrich
 
     def get(self):
         "Override default get to fetch Google Book data"
         super(BookRequest, self).get()
+        if self.enrich:
+            self.enrich_books(self.books or [], self.deadline)
 
-        # fetch covers and extra info per book
-        data = self.distpach_data([GoogleBooksRequest(book.isbn)
-                                   for book in self.books])
+        return self
 
-        # Append all fetch data to the book as an attribute
-        # it will add the field as None if not present
-        for i, book in enumerate(self.books):
-            for field in GoogleBooksRequest.FIELDS:
-                book.__setattr__(field, data[i].get(field))
+    @staticmethod
+    def enrich_books(books, deadline=None):
+        """Completes the books with the GoogleBooksRequest.FIELDS
+        Books whose data didn't arrive before the deadline list the
+        pending fields in book.missing
+        """
+        for book in BookRequest.iter_enriched(books, deadline):
+            pass
 
-        return self
+        return books
+
+    @staticmethod
+    def iter_enriched(books, deadline=None):
+        """Completes the books as enrich_books, yielding each book as soon
+        as its data arrives (or the deadline expires)
+        Covers missing in Google Books are looked up in Amazon (if there's
+        an AMAZON_ACCESS_KEY) in batches of AmazonRequest.MAX_ITEMS, those
+        books are yielded once their batch answers, with imageLinks missing
+        if it didn't in time
+        """
+        by_isbn = {}
+        for book in books:
+            by_isbn.setdefault(book.isbn, []).append(book)
+
+        def lookup_covers(isbns):
+            request = AmazonRequest(isbns, deadline=deadline)
+            request.start()
+            return request
+
+        # fetch covers and extra info for all the books at once
+        # it will add the field as None if not present
+        request = GoogleBooksBatchRequest(list(by_isbn), deadline=deadline)
+        uncovered, lookups = [], []
+        for isbn, bdata in request.stream():
+            for book in by_isbn[isbn]:
+                book.missing = (GoogleBooksRequest.FIELDS if bdata is None
+                                else ())
+                for field in GoogleBooksRequest.FIELDS:
+                    book.__setattr__(field, (bdata or {}).get(field))
+
+            if (AmazonRequest.ACCESS_KEY and to_isbn10(isbn) and
+                    not (bdata or {}).get('imageLinks')):
+                uncovered.append(isbn)
+                if len(uncovered) == AmazonRequest.MAX_ITEMS:
+                    lookups.append(lookup_covers(uncovered))
+                    uncovered = []
+                continue
+
+            for book in by_isbn[isbn]:
+                yield book
+
+        if uncovered:
+            lookups.append(lookup_covers(uncovered))
+
+        for request in lookups:
+            request.join(deadline.remaining() if deadline else None)
+            covers = (request.data if request.done else None) or {}
+            for isbn in request.isbns:
+                for book in by_isbn[isbn]:
+                    if covers.get(isbn):
+                        book.imageLinks = covers[isbn]
+                        book.missing = tuple(field for field in book.missing
+                                             if field != 'imageLinks')
+                    elif (isbn not in covers and
+                          'imageLinks' not in book.missing):
+                        book.missing += ('imageLinks',)
+                    yield book
 
     @property
     def books(self):
         return self.data
 
+    def load(self, record):
+        "Builds each Book from its cached record"
+        return Book.from_record(record)
+
+    @staticmethod
+    def make_page(**kwargs):
+        "Books pages are stored column-wise in a BookPage"
+        return BookPage(**kwargs)
+
     @staticmethod
     def _parse(bdata):
         """Parses a book receiving the BoookData element
         Non present or empty data will become None
-        Returns an initialized Book object
+        Returns the Book record, a tuple with the values of Book.FIELDS
         """
+        publisher = bdata.find('PublisherText')
+        if publisher is None:
+            publisher = etree.Element('PublisherText')
+        details = bdata.find('Details')
+        if details is None:
+            details = etree.Element('Details')
+
         bdict = {
             'book_id': bdata.get('book_id'),
             'isbn': bdata.get('isbn'),
-            'title': bdata.Title.text,
-            'title_long': bdata.TitleLong.text,
-            'authors_text': bdata.AuthorsText.text,
-            'publisher_id': bdata.PublisherText.get('publisher_id'),
-            'publisher': bdata.PublisherText.text,
-            'language': bdata.Details.get('language'),
+            'title': bdata.findtext('Title'),
+            'title_long': bdata.findtext('TitleLong'),
+            'authors_text': bdata.findtext('AuthorsText'),
+            'publisher_id': publisher.get('publisher_id'),
+            'publisher': publisher.text,
+            'language': details.get('language'),
         }
 
         # Clean the data
@@ -584,26 +1495,73 @@ class BookRequest(ISBNdbRequest):
         if authors_text:
             bdict['authors'] = [a for a in authors_text.split(',') if a]
 
-        return Book(**bdict)
+        return Book.record_of(bdict)
 
 
 class Book(object):
     """Book user class
 
     All listed fields are garanteed to exist but it can be None
+    FIELDS come from ISBNdb and ENRICHED_FIELDS are set by BookRequest
 
     All the listed fiels are strings or numbers except:
         authors: list of strings
+        imageLinks: dict of urls
+        missing: tuple of the ENRICHED_FIELDS which didn't arrive in time
+
+    Books have a fixed layout (__slots__) to keep them small
     """
 
     FIELDS = ('book_id', 'isbn', 'title', 'title_long', 'authors_text',
               'authors', 'publisher_id', 'publisher', 'language', 'extra',
               'subject', 'subject_id')
+    ENRICHED_FIELDS = GoogleBooksRequest.FIELDS + ('missing',)
+
+    __slots__ = FIELDS + ENRICHED_FIELDS
 
     def __init__(self, **kwargs):
-        for field in self.FIELDS:
+        for field in self.__slots__:
             self.__setattr__(field, kwargs.get(field, None))
 
+    @classmethod
+    def record_of(cls, bdict, fields=FIELDS):
+        "Returns the compact record of a dict of fields, a tuple of values"
+        return tuple(bdict.get(field) for field in fields)
+
+    @classmethod
+    def from_record(cls, record, fields=FIELDS):
+        "Returns a Book from its record"
+        return cls(**dict(zip(fields, record)))
+
+    def record(self, fields=__slots__):
+        "Returns the record of the book"
+        return tuple(getattr(self, field) for field in fields)
+
+    def as_dict(self, fields=__slots__):
+        "Returns the given fields as a dict, None for the ones not set"
+        return dict((field, getattr(self, field, None)) for field in fields)
+
+    @classmethod
+    def parse_fields(cls, text):
+        """Returns the fields in a comma separated list, all if it's empty
+        raises ValueError if any of them is unknown
+        """
+        if not text:
+            return cls.__slots__
+        fields = tuple(field.strip() for field in text.split(','))
+        unknown = set(fields) - set(cls.__slots__)
+        if unknown:
+            raise ValueError("Unknown fields '{0}'"
+                             .format(','.join(sorted(unknown))))
+        return fields
+
+    def __getstate__(self):
+        return self.record()
+
+    def __setstate__(self, record):
+        for field, value in zip(self.__slots__, record):
+            self.__setattr__(field, value)
+
     def __str__(self):
         return "{title} by: {author}".format(title=self.title,
                                              author=self.authors_text)
@@ -612,6 +1570,78 @@ class Book(object):
         return "{cls} {str}".format(cls=self.__class__, str=str(self))
 
 
+class BookPage(object):
+    """A page of books stored column-wise
+
+    Every field is a single tuple holding the values of all the books,
+    which takes much less memory than a list of Book objects and is cheap
+    to serialize. It has the attributes of a ResultPage, so it can take
+    its place, being the items the book records. fetched is the time when
+    the page was built from the upstream response.
+
+    Pages are pickled by the caches as their marshalled dumps(), which
+    takes half the time of pickling the columns
+
+    >>> page = BookPage(records, total_results=88, page_number=1)
+    >>> BookPage.loads(page.dumps()).books()
+    [<class 'api.Book'> Nostromo by: Joseph Conrad, ...]
+    """
+
+    __slots__ = ('fields', 'columns', 'total_results', 'page_size',
+                 'page_number', 'fetched')
+
+    def __init__(self, items=(), total_results=None, page_size=None,
+                 page_number=None, fields=Book.FIELDS, fetched=None):
+        "items are the book records, tuples of values of fields"
+        self.fields = tuple(fields)
+        self.columns = tuple(zip(*items)) or ((),) * len(self.fields)
+        self.total_results = total_results
+        self.page_size = page_size
+        self.page_number = page_number
+        self.fetched = time.time() if fetched is None else fetched
+
+    @property
+    def items(self):
+        "Returns the book records"
+        return zip(*self.columns)
+
+    def books(self):
+        "Returns the page as a list of Book objects"
+        return [Book.from_record(record, self.fields) for record in self.items]
+
+    def __len__(self):
+        return len(self.columns[0]) if self.columns else 0
+
+    def dumps(self):
+        "Serializes the page into a string"
+        return marshal.dumps(self.__getstate__())
+
+    @classmethod
+    def loads(cls, data):
+        "Builds a page serialized with dumps"
+        page = cls.__new__(cls)
+        page.__setstate__(marshal.loads(data))
+        return page
+
+    def __reduce__(self):
+        return load_page, (self.dumps(),)
+
+    def __getstate__(self):
+        return (self.fields, self.columns, self.total_results, self.page_size,
+                self.page_number, self.fetched)
+
+    def __setstate__(self, state):
+        if len(state) == 5:  # cached before pages kept their fetch time
+            state += (None,)
+        (self.fields, self.columns, self.total_results, self.page_size,
+         self.page_number, self.fetched) = state
+
+
+def load_page(data):
+    "Unpickles a BookPage, see BookPage.__reduce__"
+    return BookPage.loads(data)
+
+
 class AuthorRequest(ISBNdbRequest):
     """AuthorRequest ISBNdb API
     Handles Author related queries to return person_ids
@@ -632,11 +1662,16 @@ class AuthorRequest(ISBNdbRequest):
     The result is a list of person_id
     """
 
-    def __init__(self, name, page=1):
+    def __init__(self, name, page=1, deadline=None):
         "Gets a list of person_ids by name"
         super(AuthorRequest, self).__init__(collection='authors', field='name',
-                                            value=name, page=page, trans=lambda
-                                            e: e.get('person_id'))
+                                            value=name, page=page,
+                                            trans=self._parse,
+                                            deadline=deadline)
+
+    @staticmethod
+    def _parse(adata):
+        return adata.get('person_id')
 
     @property
     def authors(self):
@@ -665,10 +1700,14 @@ class PublisherRequest(ISBNdbRequest):
     The result is a list of publisher_id
     """
 
-    def __init__(self, name, page=1):
+    def __init__(self, name, page=1, deadline=None):
         super(PublisherRequest, self).__init__(collection='publisher',
                             field='name', value=name, page=page,
-                            trans=lambda e: e.get('publisher_id'))
+                            trans=self._parse, deadline=deadline)
+
+    @staticmethod
+    def _parse(pdata):
+        return pdata.get('publisher_id')
 
     @property
     def publishers(self):
@@ -705,10 +1744,14 @@ class SubjectRequest(ISBNdbRequest):
     The result is a list of subject_id
     """
 
-    def __init__(self, name, page=1):
+    def __init__(self, name, page=1, deadline=None):
         super(SubjectRequest, self).__init__(collection='subjects',
                             field='name', value=name, page=page,
-                            trans=lambda e: e.get('subject_id'))
+                            trans=self._parse, deadline=deadline)
+
+    @staticmethod
+    def _parse(sdata):
+        return sdata.get('subject_id')
 
     @property
     def categories(self):
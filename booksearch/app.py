@@ -4,7 +4,16 @@
 
 import os
 import json
+import time
+from datetime import datetime
 
+import metrics
+import tracing
+import settings
+from api import Book
+from api import APIRequestError
+from bulk import BulkLookup, read_isbns
+from api import GoogleBooksRequest
 from search import Search, SearchError
 
 from werkzeug.wrappers import Request, Response
@@ -14,6 +23,12 @@ from werkzeug.routing import Map, Rule, Submount
 
 from jinja2 import Environment, FileSystemLoader
 
+REQUEST_SECONDS = metrics.histogram(
+    'booksearch_request_seconds',
+    'Requests until their response is ready, by endpoint and status')
+RENDER_SECONDS = metrics.histogram(
+    'booksearch_render_seconds', 'Template rendering by template')
+
 
 class BookSearch(object):
     """
@@ -22,6 +37,11 @@ class BookSearch(object):
         urls:
             ('/', endpoint='index')
             ('/b/<by>/<query>', endpoint='search/<by>/<query>')
+            ('/b/<by>/<query>/<page>/events', endpoint='events')
+            ('/api/b/<by>/<query>/<page>', endpoint='api_search')
+            ('/api/bulk', endpoint='bulk')  POST
+            ('/admin/metrics', endpoint='metrics')
+            ('/admin/slow', endpoint='slow')
             ('/b/<slug>', endpoint='get_book/<slug')
 
         """
@@ -34,9 +54,19 @@ class BookSearch(object):
             Rule('/', endpoint='index'),
             Submount('/b', [
                 Rule('/<string:by>/<string:query>/<int:page>', endpoint='search'),
+                Rule('/<string:by>/<string:query>/<int:page>/events',
+                     endpoint='events'),
                 Rule('/<string:by>/<string:query>', endpoint='search'),
                 Rule('/<string:slug>', endpoint='get_book')
-            ])
+            ]),
+            Submount('/api/b', [
+                Rule('/<string:by>/<string:query>/<int:page>',
+                     endpoint='api_search'),
+                Rule('/<string:by>/<string:query>', endpoint='api_search'),
+            ]),
+            Rule('/api/bulk', endpoint='bulk', methods=['POST']),
+            Rule('/admin/metrics', endpoint='metrics'),
+            Rule('/admin/slow', endpoint='slow'),
         ])
 
     def on_index(self, request):
@@ -51,37 +81,188 @@ class BookSearch(object):
 
     def on_search(self, request, by, query, page=1):
         """
-        Answers with a JSON version of the search
+        Answers with the HTML results of the search
         The search uses a field to search (by) and the value (query)
         Arguments: by, query
+        With ?progressive=1 the books are listed without waiting for the
+        Google data, which is sent afterwards by the events endpoint unless
+        the search came back complete
         """
-        #mimetype = 'application/json'
+        progressive = bool(request.args.get('progressive'))
 
         try:
-            s = Search(by=by, query=query, page=page).get()
+            s = Search(by=by, query=query,
+                       page=page).get(timeout=settings.SEARCH_TIMEOUT,
+                                      enrich=not progressive)
         except SearchError, err:
             s = {'error': err}
 
-        # Make the Book class json-serializable
-        #if s.books is not None:
-        #    s.books = [b.__dict__ for b in s.books]
+        events = None
+        if progressive and isinstance(s, Search) and not s.complete:
+            events = self.url_map.bind_to_environ(request.environ).build(
+                'events', {'by': by, 'query': query, 'page': page})
+
+        return self.render('result.html', s=s, events=events)
+
+    def on_events(self, request, by, query, page):
+        """
+        Streams the Google data of the books in a search page as
+        server-sent events, one 'book' event per book as soon as it arrives
+        and a final 'end' event telling whether the search is partial
+        """
+        try:
+            s = Search(by=by, query=query, page=page).get(
+                timeout=settings.SEARCH_TIMEOUT, prefetch=False, enrich=False)
+        except SearchError:
+            s = None
+
+        def events():
+            if s is None:
+                yield self.event('end', {'partial': True})
+                return
+            for book in s.enrichments(timeout=settings.SEARCH_TIMEOUT):
+                data = dict((field, getattr(book, field))
+                            for field in GoogleBooksRequest.FIELDS)
+                data.update(book_id=book.book_id, missing=book.missing)
+                yield self.event('book', data)
+            yield self.event('end', {'partial': s.partial})
+
+        response = Response(events(), mimetype='text/event-stream',
+                            direct_passthrough=True)
+        response.headers['Cache-Control'] = 'no-cache'
+        response.headers['X-Accel-Buffering'] = 'no'  # nginx must not buffer
+        return response
 
-        return self.render('result.html', s=s)
-        #return Response(json.dumps(s.__dict__), mimetype=mimetype)
+    @staticmethod
+    def event(name, data):
+        "Formats a server-sent event"
+        return 'event: {0}\ndata: {1}\n\n'.format(name, json.dumps(data))
+
+    def on_api_search(self, request, by, query, page=1):
+        """
+        Answers with a JSON version of the search
+        ?fields=title,isbn,imageLinks chooses the fields of each book, the
+        Google data is only fetched if any of its fields is asked for
+        Responses carry ETag, Last-Modified and Cache-Control headers and
+        conditional requests are answered with 304 Not Modified
+        """
+        try:
+            fields = Book.parse_fields(request.args.get('fields'))
+        except ValueError, err:
+            return self.json({'error': str(err)}, status=400)
+
+        enrich = bool(set(fields) & set(Book.ENRICHED_FIELDS))
+        try:
+            s = Search(by=by, query=query, page=page).get(
+                timeout=settings.SEARCH_TIMEOUT, enrich=enrich)
+        except SearchError, err:
+            upstream = err.args and isinstance(err.args[0], APIRequestError)
+            return self.json({'error': str(err)},
+                             status=502 if upstream else 400)
+
+        response = self.json({
+            'by': s.by,
+            'query': s.query,
+            'page': s.page,
+            'total_pages': s.total_pages,
+            'total_results': s.total_results,
+            'more_pages': s.more_pages,
+            'partial': s.partial,
+            'books': [book.as_dict(fields) for book in s.books],
+        })
+
+        if s.partial:  # it will be complete in a moment, don't keep it
+            response.headers['Cache-Control'] = 'no-cache'
+            return response
+
+        response.cache_control.public = True
+        response.cache_control.max_age = s.max_age
+        if s.last_modified is not None:
+            response.last_modified = datetime.utcfromtimestamp(
+                int(s.last_modified))
+        response.add_etag()
+        return response.make_conditional(request)
+
+    def on_bulk(self, request):
+        """
+        Looks up a list of isbns streaming the results as NDJSON, one line
+        per isbn in input order. The isbns are sent as a JSON list, as an
+        uploaded CSV file (field 'file') or as the body, one per line
+        ?fields= chooses the fields of each book as in api_search
+        """
+        try:
+            fields = Book.parse_fields(request.args.get('fields'))
+        except ValueError, err:
+            return self.json({'error': str(err)}, status=400)
+
+        if 'file' in request.files:
+            isbns = list(read_isbns(request.files['file'].stream))
+        elif request.mimetype == 'application/json':
+            try:
+                isbns = [str(isbn) for isbn in json.loads(request.data)]
+            except (ValueError, TypeError):
+                return self.json({'error': 'Invalid JSON list'}, status=400)
+        else:
+            isbns = list(read_isbns(request.data.splitlines()))
+
+        if len(isbns) > settings.BULK_MAX_ISBNS:
+            return self.json({'error': 'At most {0} isbns per request'
+                              .format(settings.BULK_MAX_ISBNS)}, status=413)
+
+        return Response(BulkLookup(isbns, fields).ndjson(),
+                        mimetype='application/x-ndjson',
+                        direct_passthrough=True)
+
+    def on_metrics(self, request):
+        "Answers with the metrics in the Prometheus text format"
+        return Response(metrics.exposition(),
+                        mimetype='text/plain; version=0.0.4')
+
+    def on_slow(self, request):
+        "Lists the traces of the last slow or profiled requests"
+        return self.render('slow.html', traces=list(tracing.slow),
+                           threshold=tracing.slow.threshold)
 
     #### WSGI stuff
     def dispatch_request(self, request):
+        """Runs the endpoint within the trace of the request, which is kept
+        if it's slow. With ?profile=1 (if PROFILE_REQUESTS) it's profiled
+        """
         adapter = self.url_map.bind_to_environ(request.environ)
-        try:
-            endpoint, values = adapter.match()
-            return getattr(self, 'on_' + endpoint)(request, **values)
-        except HTTPException, e:
-            return e
+        start, endpoint, profiler = time.time(), 'unmatched', None
+        with tracing.start(request.path) as trace:
+            if settings.PROFILE_REQUESTS and request.args.get('profile'):
+                profiler = tracing.Profiler(trace,
+                                            settings.PROFILE_INTERVAL).start()
+            try:
+                endpoint, values = adapter.match()
+                response = getattr(self, 'on_' + endpoint)(request, **values)
+            except HTTPException, e:
+                response = e
+            finally:
+                if profiler is not None:
+                    profiler.stop()
+
+        if endpoint not in ('metrics', 'slow'):
+            tracing.slow.add(trace, force=profiler is not None)
+        REQUEST_SECONDS.observe(time.time() - start, endpoint=endpoint,
+                                status=response.code
+                                if isinstance(response, HTTPException)
+                                else response.status_code)
+        return response
+
+    @staticmethod
+    def json(data, status=200):
+        "Returns a JSON Response"
+        return Response(json.dumps(data), status=status,
+                        mimetype='application/json')
 
     def render(self, template_name, **context):
         "Renders the given template and returns a Response"
         t = self.jinja_env.get_template(template_name)
-        return Response(t.render(context), mimetype='text/html')
+        with RENDER_SECONDS.time(template=template_name):
+            body = t.render(context)
+        return Response(body, mimetype='text/html')
 
     def wsgi_app(self, environ, start_response):
         "Basics to respond to HTTP requests"
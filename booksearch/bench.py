@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+"""
+Reproducible benchmarks of the searches, run against replayed upstream
+responses (see standin.py) with a fixed latency and error rate.
+
+    $ python bench.py --latency 0.05 --error-rate 0.01 --output bench_output.txt
+
+Searches are run missing the caches, hitting the upstream responses cache
+and hitting the finished searches one. Each scenario reports its
+throughput, the p50/p95/p99 latencies and the peak RSS of the process until
+then.
+"""
+import time
+import random
+import urllib2
+import argparse
+import resource
+import threading
+
+from werkzeug.serving import make_server, WSGIRequestHandler
+
+import settings
+# Rate limits are for the real providers, the benchmarks measure the code,
+# and the requests log would bury the report
+settings.RATE_LIMITS = {}
+settings.LOG_REQUESTS = False
+
+import standin
+from app import create_app
+from search import Search, SearchError
+from api import APIRequest, APIRequestError, BookRequest
+from transport import ReplayTransport
+
+
+def percentile(values, percent):
+    "percent percentile of the sorted values"
+    return values[min(len(values) - 1, int(len(values) * percent / 100.0))]
+
+
+def peak_rss():
+    "Peak resident memory of the process in MB"
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def query(by, n):
+    "The nth query of a filter"
+    if by == 'isbn':
+        return standin.make_isbn(n)
+    if by == 'book_id':
+        return 'book_{0}'.format(n)
+    return '{0} {1}'.format(by, n)
+
+
+class QuietHandler(WSGIRequestHandler):
+    "Request handler without access log"
+
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+class Benchmark(object):
+    """Runs the scenarios and collects their results
+
+    >>> bench = Benchmark(runs=50, concurrency=8)
+    >>> bench.run()
+    >>> print bench.report()
+    """
+
+    HEADER = '{0:<26} {1:>6} {2:>6} {3:>9} {4:>8} {5:>8} {6:>8} {7:>8}'.format(
+        'scenario', 'runs', 'errors', 'ops/s', 'p50 ms', 'p95 ms', 'p99 ms',
+        'peak MB')
+
+    def __init__(self, runs=50, concurrency=8, timeout=settings.SEARCH_TIMEOUT):
+        self.runs = runs
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.results = []
+
+    def run(self):
+        "Runs all the scenarios"
+        for by in Search.FILTERS:
+            for tier in ('miss', 'upstream', 'front'):
+                self.measure('search {0} {1}'.format(by, tier),
+                             self.search(by, tier))
+        self.measure('enrich', self.enrich())
+
+        server = make_server('127.0.0.1', 0, create_app(), threaded=True,
+                             request_handler=QuietHandler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            self.measure('wsgi', self.wsgi('http://127.0.0.1:{0}'.format(
+                server.server_address[1])), self.concurrency)
+        finally:
+            server.shutdown()
+
+    def measure(self, name, calls, concurrency=1):
+        "Times the calls, functions run by concurrency threads"
+        calls = iter(calls)
+        lock = threading.Lock()
+        latencies, errors = [], [0]
+
+        def worker():
+            while True:
+                with lock:
+                    call = next(calls, None)
+                if call is None:
+                    return
+                start = time.time()
+                try:
+                    call()
+                except Exception:
+                    with lock:
+                        errors[0] += 1
+                with lock:
+                    latencies.append(time.time() - start)
+
+        start = time.time()
+        threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - start
+
+        latencies.sort()
+        self.results.append((name, len(latencies), errors[0],
+                             len(latencies) / elapsed,
+                             percentile(latencies, 50) * 1000,
+                             percentile(latencies, 95) * 1000,
+                             percentile(latencies, 99) * 1000,
+                             peak_rss()))
+
+    def search(self, by, tier):
+        """Searches by a filter missing both caches ('miss'), hitting the
+        upstream responses cache ('upstream') or the finished searches one
+        ('front'), which are warmed up first
+        """
+        def call(n):
+            if tier == 'miss':
+                APIRequest.cache.clear()
+            if tier != 'front':
+                Search.finished.clear()
+            Search(by, query(by, n)).get(self.timeout, prefetch=False)
+
+        if tier != 'miss':
+            for n in range(self.runs):
+                try:
+                    call(n)
+                except (APIRequestError, SearchError):
+                    pass
+        return [lambda n=n: call(n) for n in range(self.runs)]
+
+    def enrich(self):
+        "Enriches pages of books with the Google Books data, not cached"
+        def call(books):
+            APIRequest.cache.clear()
+            BookRequest.enrich_books(books)
+
+        pages = []
+        for n in range(self.runs):
+            try:
+                pages.append(BookRequest(field='title', value=query('title', n),
+                                         enrich=False).get().books)
+            except APIRequestError:
+                pass
+        return [lambda books=books: call(books) for books in pages]
+
+    def wsgi(self, base):
+        """Requests to the application served at base, a mix of pages and
+        JSON searches, some of them repeated
+        """
+        APIRequest.cache.clear()
+        Search.finished.clear()
+        rand = random.Random(0)
+        urls = []
+        for _ in range(self.runs * self.concurrency):
+            by = rand.choice(Search.FILTERS)
+            urls.append('{0}/{1}/{2}/{3}/1'.format(
+                base, rand.choice(('b', 'api/b')), by,
+                urllib2.quote(query(by, rand.randint(0, self.runs)))))
+        return [lambda url=url: urllib2.urlopen(url).read() for url in urls]
+
+    def report(self):
+        "Table of the results"
+        lines = [self.HEADER]
+        for result in self.results:
+            lines.append('{0:<26} {1:>6} {2:>6} {3:>9.1f} {4:>8.1f} {5:>8.1f} '
+                         '{6:>8.1f} {7:>8.1f}'.format(*result))
+        return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmarks the searches against replayed responses')
+    parser.add_argument('--runs', type=int, default=50,
+                        help='calls per scenario (per thread for wsgi)')
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help='concurrent clients of the wsgi scenario')
+    parser.add_argument('--fixtures', default='fixtures',
+                        help='recorded responses, the rest are synthetic')
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='average seconds of each upstream call')
+    parser.add_argument('--error-rate', type=float, default=0,
+                        help='part of the upstream calls failing')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', type=argparse.FileType('w'),
+                        help='file to write the report to as well')
+    args = parser.parse_args()
+
+    APIRequest.transport = ReplayTransport(
+        args.fixtures, standin.CREDENTIALS, args.latency, args.error_rate,
+        standin.synthetic, args.seed)
+
+    bench = Benchmark(args.runs, args.concurrency)
+    bench.run()
+
+    report = bench.report()
+    print report
+    if args.output:
+        args.output.write(report + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+"""
+Bulk isbn lookups for catalog imports.
+
+    $ python bulk.py isbns.csv > books.ndjson
+    $ cat isbns.txt | python bulk.py --fields isbn,title,imageLinks
+"""
+import csv
+import sys
+import json
+import argparse
+
+import pool
+import settings
+from api import Book
+from api import to_isbn13
+from api import BookRequest
+
+
+def read_isbns(lines):
+    """Yields the isbns in a CSV file (or a plain list, one per line)
+    The column with an 'isbn' header is used if there's one, otherwise
+    the first column
+    """
+    column, first = 0, True
+    for row in csv.reader(lines):
+        if not any(cell.strip() for cell in row):
+            continue
+        if first:
+            first = False
+            header = [cell.strip().lower() for cell in row]
+            if 'isbn' in header:
+                column = header.index('isbn')
+                continue
+        if column < len(row) and row[column].strip():
+            yield row[column].strip()
+
+
+class BulkLookup(object):
+    """Looks up a large list of isbns
+
+    The isbns are normalized to ISBN-13 and each one is fetched only once.
+    They are processed in chunks: the ISBNdb lookups of a chunk run in the
+    isbndb worker pool, so its size bounds the concurrency, while the
+    previous chunk is enriched with batched Google searches. All of it is
+    queued with pool.BULK priority, behind the user searches.
+
+    Results are yielded in input order as dicts with the isbn as given
+    (input), its ISBN-13 (isbn), a status ('ok', 'invalid', 'not_found',
+    'error') and the book with the chosen fields.
+
+    >>> for result in BulkLookup(['0-553-80457-X', 'nope']).results():
+    ...     print result['status'], result['isbn']
+    ok 9780553804577
+    invalid None
+    """
+
+    def __init__(self, isbns, fields=Book.__slots__,
+                 chunk_size=settings.BULK_CHUNK_SIZE):
+        self.isbns = isbns
+        self.fields = fields
+        self.chunk_size = chunk_size
+        # The Google data is only fetched if any of its fields is wanted
+        self.enrich = bool(set(fields) & set(Book.ENRICHED_FIELDS))
+        self.started = set()  # ISBN-13 already looked up
+        self.found = {}  # ISBN-13 -> result, to answer duplicates
+
+    def results(self):
+        "Yields the result of each isbn in input order"
+        pending = None
+        for chunk in self._chunks():
+            requests = self._start(chunk)
+            if pending is not None:
+                for result in self._finish(*pending):
+                    yield result
+            pending = (chunk, requests)
+
+        if pending is not None:
+            for result in self._finish(*pending):
+                yield result
+
+    def ndjson(self):
+        "Yields the results as lines of JSON"
+        for result in self.results():
+            yield json.dumps(result) + '\n'
+
+    def _chunks(self):
+        "Yields lists of (isbn, ISBN-13) of chunk_size"
+        chunk = []
+        for isbn in self.isbns:
+            chunk.append((isbn, to_isbn13(isbn)))
+            if len(chunk) == self.chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def _start(self, chunk):
+        "Starts the ISBNdb lookups of the isbns not seen before"
+        requests = {}
+        with pool.priority(pool.BULK):
+            for isbn, isbn13 in chunk:
+                if isbn13 is not None and isbn13 not in self.started:
+                    self.started.add(isbn13)
+                    requests[isbn13] = BookRequest(field='isbn', value=isbn13,
+                                                   enrich=False)
+                    requests[isbn13].start()
+        return requests
+
+    def _finish(self, chunk, requests):
+        "Waits for the lookups of a chunk, enriches them and yields them"
+        books = {}
+        for isbn13, request in requests.iteritems():
+            request.join()
+            if request.task.error is not None:
+                self.found[isbn13] = {'status': 'error',
+                                      'error': str(request.task.error)}
+            elif not request.books:
+                self.found[isbn13] = {'status': 'not_found'}
+            else:
+                books[isbn13] = request.books[0]
+
+        if self.enrich:
+            with pool.priority(pool.BULK):
+                BookRequest.enrich_books(books.values())
+        for isbn13, book in books.iteritems():
+            self.found[isbn13] = {'status': 'ok',
+                                  'book': book.as_dict(self.fields)}
+
+        for isbn, isbn13 in chunk:
+            result = {'input': isbn, 'isbn': isbn13, 'status': 'invalid'}
+            result.update(self.found.get(isbn13, {}))
+            yield result
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Looks up a list of isbns writing the books as NDJSON')
+    parser.add_argument('file', nargs='?', type=argparse.FileType('rb'),
+                        default=sys.stdin,
+                        help='CSV file or list of isbns (default: stdin)')
+    parser.add_argument('--fields', default='',
+                        help='comma separated book fields (default: all)')
+    args = parser.parse_args()
+
+    try:
+        fields = Book.parse_fields(args.fields)
+    except ValueError, err:
+        parser.error(str(err))
+
+    # The requests log goes to stderr, stdout is for the results
+    out, sys.stdout = sys.stdout, sys.stderr
+    for line in BulkLookup(read_isbns(args.file), fields).ndjson():
+        out.write(line)
+        out.flush()
+
+
+if __name__ == '__main__':
+    main()
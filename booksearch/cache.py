@@ -0,0 +1,459 @@
+# -*- coding: utf-8 -*-
+"""
+Cache backends for the processed upstream responses.
+
+    MemoryCache      in-process
+    ObjectCache      in-process, of live objects (the finished searches)
+    SQLiteCache      on-disk, shared by all the processes of a host
+    MemcachedCache   networked, any memcached compatible server
+
+The backend in use is chosen with CACHE_BACKEND and CACHE_OPTIONS in settings.
+"""
+import sys
+import zlib
+import socket
+import sqlite3
+import binascii
+import threading
+import SocketServer
+import cPickle as pickle
+from time import time
+from collections import OrderedDict
+
+from werkzeug.contrib.cache import BaseCache
+
+
+# Serialized values bigger than this are compressed
+COMPRESS_MIN_SIZE = 512
+
+
+def dumps(value):
+    """Serializes value in a compact binary string
+    The first byte tells whether the pickle is compressed or not
+    """
+    blob = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+    if len(blob) > COMPRESS_MIN_SIZE:
+        return 'z' + zlib.compress(blob)
+    return 'p' + blob
+
+
+def loads(data):
+    "Deserializes a value serialized with dumps"
+    if data[0] == 'z':
+        return pickle.loads(zlib.decompress(data[1:]))
+    return pickle.loads(data[1:])
+
+
+def create_cache(backend, **options):
+    """Returns a cache of the given backend ('memory', 'sqlite' or
+    'memcached') initialized with options
+    """
+    backends = {
+        'memory': MemoryCache,
+        'sqlite': SQLiteCache,
+        'memcached': MemcachedCache,
+    }
+    if backend not in backends:
+        raise ValueError("Unknown cache backend '{0}'".format(backend))
+    return backends[backend](**options)
+
+
+class MemoryCache(BaseCache):
+    """In-process cache bounded both in entries and in bytes
+
+    Values are kept pickled, so their size is known and the cached objects
+    can't be modified by whoever gets them. When any of the limits is
+    exceeded the least recently used entries are evicted.
+
+    >>> cache = MemoryCache(threshold=1000, max_bytes=64 * 1024 * 1024)
+    >>> cache.set('key', [1, 2, 3])
+    >>> cache.get('key')
+    [1, 2, 3]
+    """
+
+    def __init__(self, threshold=500, default_timeout=300, max_bytes=None):
+        BaseCache.__init__(self, default_timeout)
+        self._cache = OrderedDict()
+        self._threshold = threshold
+        self._max_bytes = max_bytes
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._cache.pop(key, None)
+            if entry is None:
+                return None
+            expires, blob = entry
+            if expires <= time():
+                self._bytes -= len(blob)
+                return None
+            self._cache[key] = entry  # most recently used go last
+
+        return pickle.loads(blob)
+
+    def set(self, key, value, timeout=None):
+        if timeout is None:
+            timeout = self.default_timeout
+        blob = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+        with self._lock:
+            self._remove(key)
+            self._cache[key] = (time() + timeout, blob)
+            self._bytes += len(blob)
+            self._prune()
+
+    def add(self, key, value, timeout=None):
+        if self.get(key) is None:
+            self.set(key, value, timeout)
+
+    def delete(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+            self._bytes = 0
+
+    @property
+    def size(self):
+        "Number of bytes held by the cached values"
+        return self._bytes
+
+    def _remove(self, key):
+        entry = self._cache.pop(key, None)
+        if entry is not None:
+            self._bytes -= len(entry[1])
+
+    def _prune(self):
+        "Evicts the least recently used entries until within the limits"
+        while self._cache and (len(self._cache) > self._threshold or
+                               (self._max_bytes is not None and
+                                self._bytes > self._max_bytes)):
+            self._remove(next(iter(self._cache)))
+
+
+class ObjectCache(BaseCache):
+    """In-process LRU cache of live objects
+
+    Unlike MemoryCache values are kept as they are, a hit costs a dictionary
+    lookup, so whoever gets them must not modify them. At most `threshold`
+    entries are kept, the least recently used are evicted.
+
+    >>> cache = ObjectCache(threshold=500, default_timeout=60)
+    >>> cache.set('key', books)
+    >>> cache.get('key') is books
+    True
+    """
+
+    def __init__(self, threshold=500, default_timeout=60):
+        BaseCache.__init__(self, default_timeout)
+        self._cache = OrderedDict()
+        self._threshold = threshold
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._cache.pop(key, None)
+            if entry is None or entry[0] <= time():
+                return None
+            self._cache[key] = entry  # most recently used go last
+            return entry[1]
+
+    def set(self, key, value, timeout=None):
+        if timeout is None:
+            timeout = self.default_timeout
+        with self._lock:
+            self._cache.pop(key, None)
+            self._cache[key] = (time() + timeout, value)
+            while len(self._cache) > self._threshold:
+                self._cache.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._cache.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+
+class SQLiteCache(BaseCache):
+    """On-disk cache in a SQLite database
+
+    All the worker processes of a host can share the same file, which also
+    survives restarts. Expired entries are purged every `prune_every` sets,
+    evicting the ones closer to expire when there are more than threshold.
+
+    >>> cache = SQLiteCache('/var/tmp/booksearch.sqlite', threshold=100000)
+    """
+
+    def __init__(self, path, threshold=10000, default_timeout=300,
+                 prune_every=100):
+        BaseCache.__init__(self, default_timeout)
+        self._path = path
+        self._threshold = threshold
+        self._prune_every = prune_every
+        self._sets = 0
+        self._local = threading.local()
+        with self._connection() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS cache '
+                         '(key TEXT PRIMARY KEY, expires REAL, value BLOB)')
+            conn.execute('CREATE INDEX IF NOT EXISTS cache_expires '
+                         'ON cache (expires)')
+
+    def _connection(self):
+        "sqlite3 connections can't be shared among threads, one per thread"
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self._path, timeout=5)
+            conn.text_factory = str
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+        return conn
+
+    def get(self, key):
+        row = self._connection().execute(
+            'SELECT value FROM cache WHERE key = ? AND expires > ?',
+            (key, time())).fetchone()
+        if row is not None:
+            return loads(str(row[0]))
+
+    def set(self, key, value, timeout=None):
+        if timeout is None:
+            timeout = self.default_timeout
+        with self._connection() as conn:
+            conn.execute('INSERT OR REPLACE INTO cache VALUES (?, ?, ?)',
+                         (key, time() + timeout, buffer(dumps(value))))
+
+        self._sets += 1
+        if self._sets % self._prune_every == 0:
+            self._prune()
+
+    def add(self, key, value, timeout=None):
+        if self.get(key) is None:
+            self.set(key, value, timeout)
+
+    def delete(self, key):
+        with self._connection() as conn:
+            conn.execute('DELETE FROM cache WHERE key = ?', (key,))
+
+    def clear(self):
+        with self._connection() as conn:
+            conn.execute('DELETE FROM cache')
+
+    def _prune(self):
+        "Removes expired entries and the soonest to expire above threshold"
+        with self._connection() as conn:
+            conn.execute('DELETE FROM cache WHERE expires <= ?', (time(),))
+            conn.execute('DELETE FROM cache WHERE key IN (SELECT key FROM '
+                         'cache ORDER BY expires DESC LIMIT -1 OFFSET ?)',
+                         (self._threshold,))
+
+
+class MemcachedCache(BaseCache):
+    """Networked cache speaking the memcached text protocol
+
+    Keys are spread among the servers by their crc32. Network errors are
+    taken as cache misses so a lost server only makes the cache colder.
+
+    >>> cache = MemcachedCache(['10.0.0.1:11211', '10.0.0.2:11211'])
+    """
+
+    def __init__(self, servers=('127.0.0.1:11211',), default_timeout=300,
+                 socket_timeout=0.5):
+        BaseCache.__init__(self, default_timeout)
+        self._servers = []
+        for server in servers:
+            host, port = server.rsplit(':', 1)
+            self._servers.append((host, int(port)))
+        self._socket_timeout = socket_timeout
+        self._local = threading.local()
+
+    def get(self, key):
+        try:
+            sock, reader = self._connection(key)
+            sock.sendall('get {0}\r\n'.format(key))
+            header = reader.readline()
+            if not header.startswith('VALUE'):
+                return None
+            size = int(header.split()[3])
+            data = reader.read(size + 2)[:-2]
+            reader.readline()  # END
+            return loads(data)
+        except (socket.error, IndexError, ValueError):
+            self._disconnect(key)
+
+    def set(self, key, value, timeout=None):
+        if timeout is None:
+            timeout = self.default_timeout
+        self._store('set', key, dumps(value), timeout)
+
+    def add(self, key, value, timeout=None):
+        if timeout is None:
+            timeout = self.default_timeout
+        self._store('add', key, dumps(value), timeout)
+
+    def delete(self, key):
+        self._command(key, 'delete {0}\r\n'.format(key))
+
+    def clear(self):
+        for server in self._servers:
+            self._command(server, 'flush_all\r\n')
+
+    def _store(self, command, key, data, timeout):
+        self._command(key, '{0} {1} 0 {2} {3}\r\n{4}\r\n'
+                      .format(command, key, int(timeout), len(data), data))
+
+    def _command(self, key, line):
+        "Sends a command whose answer is a single line"
+        try:
+            sock, reader = self._connection(key)
+            sock.sendall(line)
+            return reader.readline()
+        except socket.error:
+            self._disconnect(key)
+
+    def _server(self, key):
+        if isinstance(key, tuple):
+            return key
+        return self._servers[(binascii.crc32(key) & 0xffffffff) %
+                             len(self._servers)]
+
+    def _connection(self, key):
+        "Returns the (socket, reader) to the server of key for this thread"
+        server = self._server(key)
+        connections = self._local.__dict__.setdefault('connections', {})
+        if server not in connections:
+            sock = socket.create_connection(server, self._socket_timeout)
+            connections[server] = (sock, sock.makefile('rb'))
+        return connections[server]
+
+    def _disconnect(self, key):
+        connections = self._local.__dict__.get('connections', {})
+        sock, reader = connections.pop(self._server(key), (None, None))
+        if sock is not None:
+            sock.close()
+
+
+class MemcachedHandler(SocketServer.StreamRequestHandler):
+    """Stand-in memcached server backed by a MemoryCache
+    Understands get, set, add, delete and flush_all, enough for
+    MemcachedCache in development and benchmarks:
+
+        $ python cache.py 11211
+    """
+
+    def handle(self):
+        cache = self.server.cache
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            args = line.split()
+            if not args:
+                continue
+            command = args[0]
+
+            if command == 'get':
+                for key in args[1:]:
+                    data = cache.get(key)
+                    if data is not None:
+                        self.wfile.write('VALUE {0} 0 {1}\r\n{2}\r\n'
+                                         .format(key, len(data), data))
+                self.wfile.write('END\r\n')
+            elif command in ('set', 'add'):
+                key, timeout, size = args[1], int(args[3]), int(args[4])
+                data = self.rfile.read(size + 2)[:-2]
+                if command == 'add' and cache.get(key) is not None:
+                    self.wfile.write('NOT_STORED\r\n')
+                else:
+                    cache.set(key, data, timeout or 30 * 24 * 3600)
+                    self.wfile.write('STORED\r\n')
+            elif command == 'delete':
+                cache.delete(args[1])
+                self.wfile.write('DELETED\r\n')
+            elif command == 'flush_all':
+                cache.clear()
+                self.wfile.write('OK\r\n')
+            else:
+                self.wfile.write('ERROR\r\n')
+
+
+class MemcachedServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, cache=None):
+        SocketServer.TCPServer.__init__(self, address, MemcachedHandler)
+        self.cache = cache or MemoryCache(threshold=100000)
+
+
+class SingleFlightTimeout(Exception):
+    "Raised when waiting for the call of another thread takes too long"
+    pass
+
+
+class _Call(object):
+    "A call in flight, shared by all the callers of the same key"
+
+    def __init__(self):
+        self.finished = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """Deduplicates concurrent calls with the same key
+
+    The first caller of a key runs the function while the ones arriving
+    meanwhile wait for it and get the same result, or the same exception.
+
+    >>> flights = SingleFlight()
+    >>> flights.do('key', fetch, url)  # only one fetch at a time per key
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def busy(self, key):
+        "Returns if there is a call in flight for key"
+        return key in self._calls
+
+    def do(self, key, fn, *args, **kwargs):
+        """Runs fn(*args, **kwargs) unless it's already running for key
+        wait_timeout (seconds) limits the time waiting for another caller,
+        raising SingleFlightTimeout when exceeded
+        """
+        wait_timeout = kwargs.pop('wait_timeout', None)
+
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            if not call.finished.wait(wait_timeout):
+                raise SingleFlightTimeout(key)
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn(*args, **kwargs)
+            return call.result
+        except Exception, err:
+            call.error = err
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.finished.set()
+
+
+if __name__ == '__main__':
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 11211
+    MemcachedServer(('127.0.0.1', port)).serve_forever()
@@ -0,0 +1,417 @@
+# -*- coding: utf-8 -*-
+"""
+Local catalog of the books seen, to answer searches without going upstream.
+
+The catalog file is memory-mapped, its layout is:
+
+    header   MAGIC, counts and offsets of the sections (HEADER)
+    fields   marshalled tuple of the Book fields of the records
+    pages    marshalled {(filter, query, page): (seen, isbn13s, totals)} of
+             the search pages, as listed upstream
+    records  (isbn13, data offset, data length) sorted by isbn13 (RECORD)
+    tokens   (string offset, length, postings offset, count) sorted (TOKEN)
+    strings  the tokens, words qualified by their filter as 'author:neal'
+    postings record numbers of each token, uint32
+    data     marshalled (seen, record) of each book
+
+New books are kept in memory and written along the ones in the file every
+CATALOG_SAVE_EVERY books, replacing it. Several processes can share the
+file: writes are serialized by a lock file and merge the current file, and
+readers map it again once it's replaced.
+"""
+import os
+import re
+import mmap
+import fcntl
+import time
+import heapq
+import array
+import struct
+import marshal
+import itertools
+import threading
+from contextlib import contextmanager
+
+import pool
+import settings
+from api import Book
+from api import to_isbn13
+
+
+MAGIC = 'BSCAT005'
+HEADER = struct.Struct('<8sIIIIIIIII')
+RECORD = struct.Struct('<13sII')
+TOKEN = struct.Struct('<IHII')
+
+# Fields searched by each filter answered by the catalog, their words are
+# indexed qualified by the filter
+FILTER_FIELDS = {
+    'title': ('title', 'title_long'),
+    'author': ('authors_text',),
+    'publisher': ('publisher',),
+}
+
+
+def tokens(text):
+    "Lowercase words of a text, as utf-8 strings"
+    if not text:
+        return set()
+    if isinstance(text, str):
+        text = text.decode('utf-8', 'replace')
+    return set(word.encode('utf-8')
+               for word in re.findall(r'\w+', text.lower(), re.UNICODE))
+
+
+def indexed(record):
+    "Tokens of the filters of a record, a dict of its fields"
+    return set('{0}:{1}'.format(by, word)
+               for by, fields in FILTER_FIELDS.iteritems()
+               for field in fields for word in tokens(record.get(field)))
+
+
+def normalize(query):
+    "Lowercase query with single spaces, as utf-8"
+    if isinstance(query, unicode):
+        query = query.encode('utf-8')
+    return ' '.join(query.lower().split())
+
+
+class CatalogFile(object):
+    """Read-only view of a catalog file, memory-mapped
+    Lookups are binary searches on the sorted tables, so nothing but the
+    records asked for is decoded
+    """
+
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, self.size, self.token_count, fields, pages, self.records,
+         self.tokens, self.strings, self.postings,
+         self.data) = HEADER.unpack_from(self.map)
+        if magic != MAGIC:
+            raise ValueError('{0} is not a catalog file'.format(path))
+        self.fields = marshal.loads(self.map[fields:pages])
+        self.pages = marshal.loads(self.map[pages:self.records])
+
+    def __len__(self):
+        return self.size
+
+    def isbn(self, number):
+        "isbn13 of the nth record"
+        return RECORD.unpack_from(self.map, self.records +
+                                  number * RECORD.size)[0]
+
+    def load(self, number):
+        "Returns (seen, record) of the nth record"
+        _, offset, length = RECORD.unpack_from(
+            self.map, self.records + number * RECORD.size)
+        return marshal.loads(self.map[self.data + offset:
+                                      self.data + offset + length])
+
+    def find(self, isbn13):
+        "Returns the number of the record of isbn13, None if there's none"
+        low, high = 0, self.size
+        while low < high:
+            middle = (low + high) // 2
+            key = self.isbn(middle)
+            if key == isbn13:
+                return middle
+            if key < isbn13:
+                low = middle + 1
+            else:
+                high = middle
+        return None
+
+    def token(self, number):
+        "Returns (token, postings offset, count) of the nth token"
+        offset, length, postings, count = TOKEN.unpack_from(
+            self.map, self.tokens + number * TOKEN.size)
+        start = self.strings + offset
+        return self.map[start:start + length], postings, count
+
+    def matching(self, token):
+        "Returns the numbers of the records with token, an array"
+        low, high = 0, self.token_count
+        while low < high:
+            middle = (low + high) // 2
+            key, postings, count = self.token(middle)
+            if key == token:
+                numbers = array.array('I')
+                start = self.postings + postings * numbers.itemsize
+                numbers.fromstring(self.map[start:start +
+                                            count * numbers.itemsize])
+                return numbers
+            if key < token:
+                low = middle + 1
+            else:
+                high = middle
+        return array.array('I')
+
+    def __iter__(self):
+        "Yields (isbn13, (seen, record)) of all the records"
+        for number in xrange(self.size):
+            yield self.isbn(number), self.load(number)
+
+
+def load(path):
+    "Maps the catalog file at path, None if there's none or it's older"
+    try:
+        mapped = CatalogFile(path)
+    except (EnvironmentError, ValueError, struct.error):
+        return None
+    return mapped if mapped.fields == Book.__slots__ else None
+
+
+@contextmanager
+def locked(path):
+    "Holds an exclusive lock on the file at path, shared by the processes"
+    with open(path, 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def newest(*entries):
+    "Merges dicts of (seen, ...) entries keeping the newest of each key"
+    merged = {}
+    for entry in entries:
+        for key, value in entry.iteritems():
+            if key not in merged or merged[key][0] < value[0]:
+                merged[key] = value
+    return merged
+
+
+def write(path, fields, books, pages=None):
+    """Writes a catalog file with books, an iterable of (isbn13, (seen,
+    record)) sorted by isbn13, and the search pages, replacing path once
+    it's complete
+    """
+    isbns, data, offsets, index = [], [], [], {}
+    offset = 0
+    for number, (isbn13, entry) in enumerate(books):
+        blob = marshal.dumps(entry)
+        isbns.append(isbn13)
+        offsets.append((offset, len(blob)))
+        data.append(blob)
+        offset += len(blob)
+        for token in indexed(dict(zip(fields, entry[1]))):
+            index.setdefault(token, array.array('I')).append(number)
+
+    fields_blob = marshal.dumps(tuple(fields))
+    table = [RECORD.pack(isbn13, start, length)
+             for isbn13, (start, length) in zip(isbns, offsets)]
+    strings, token_table, postings, string_at, posting_at = [], [], [], 0, 0
+    for token in sorted(index):
+        token_table.append(TOKEN.pack(string_at, len(token), posting_at,
+                                      len(index[token])))
+        strings.append(token)
+        postings.append(index[token].tostring())
+        string_at += len(token)
+        posting_at += len(index[token])
+
+    sections = [fields_blob, marshal.dumps(pages or {}), ''.join(table),
+                ''.join(token_table), ''.join(strings), ''.join(postings)]
+    starts = [HEADER.size]
+    for section in sections:
+        starts.append(starts[-1] + len(section))
+
+    temporary = '{0}.{1}.tmp'.format(path, os.getpid())
+    with open(temporary, 'wb') as output:
+        output.write(HEADER.pack(MAGIC, len(isbns), len(index), *starts))
+        for section in sections:
+            output.write(section)
+        for blob in data:
+            output.write(blob)
+    os.rename(temporary, path)
+
+
+class Catalog(object):
+    """Every book seen, with its Google data, indexed by isbn and by the
+    words of its FILTER_FIELDS, and the search pages they were listed in
+
+    Books and pages are kept with the time they were seen, the ones older
+    than max_age are stale and not answered
+
+    >>> catalog = Catalog('/var/tmp/booksearch-catalog')
+    >>> catalog.add(search.books, search.key, (88, 9, True))
+    >>> catalog.get('9780553804577')
+    <class 'api.Book'> Cryptonomicon by: Neal Stephenson
+    >>> catalog.page(search.key)
+    ([<class 'api.Book'> Cryptonomicon by: Neal Stephenson, ...], (88, 9, True))
+    >>> catalog.search('author', 'neal stephenson', page=1)
+    ([<class 'api.Book'> Anathem by: Neal Stephenson, ...], 12)
+    """
+
+    def __init__(self, path, max_age=settings.CATALOG_MAX_AGE,
+                 save_every=settings.CATALOG_SAVE_EVERY):
+        self.path = path
+        self.max_age = max_age
+        self.save_every = save_every
+        self.file = None  # an older layout is written again on save
+        self.identity = None  # (inode, mtime) of the file when mapped
+        self.new = {}  # isbn13 -> (seen, record) not written yet
+        self.pages = {}  # search key -> (seen, isbn13s, totals) not written
+        self.index = {}  # token -> set of isbn13 of the new books
+        self.saving = False
+        self.lock = threading.Lock()
+        self._mapped()
+
+    def add(self, books, key=None, totals=None):
+        """Records the complete books, saving the catalog every save_every
+        With the key of the search page they were listed in, (filter,
+        normalized query, page), and its (total_results, total_pages,
+        more_pages), the page is recorded too if all its books are
+        """
+        seen = time.time()
+        listed = []
+        with self.lock:
+            for book in books:
+                isbn13 = to_isbn13(book.isbn or '')
+                if isbn13 is None or book.missing:
+                    listed = None
+                    continue
+                isbn13 = str(isbn13)
+                record = book.record()
+                self.new[isbn13] = (seen, record)
+                for token in indexed(dict(zip(Book.__slots__, record))):
+                    self.index.setdefault(token, set()).add(isbn13)
+                if listed is not None:
+                    listed.append(isbn13)
+
+            if key is not None and listed is not None:
+                self.pages[key] = (seen, tuple(listed), tuple(totals))
+
+            save = len(self.new) >= self.save_every and not self.saving
+            self.saving = self.saving or save
+        if save:
+            pool.get_pool('catalog').submit(self.save)
+
+    def page(self, key):
+        """Returns (books, totals) of a search page as it was listed, None
+        if it's unknown or it or any of its books is stale
+        """
+        mapped = self._mapped()
+        with self.lock:
+            entry = self.pages.get(key)
+        if entry is None and mapped is not None:
+            entry = mapped.pages.get(key)
+        if entry is None or self.stale(entry):
+            return None
+
+        _, listed, totals = entry
+        entries = [self._entry(isbn13, mapped) for isbn13 in listed]
+        if any(entry is None or self.stale(entry) for entry in entries):
+            return None
+        return ([Book.from_record(record, Book.__slots__)
+                 for _, record in entries], totals)
+
+    def get(self, isbn13):
+        "Returns the Book of an isbn13 if it's known and fresh, or None"
+        entry = self._entry(str(isbn13), self._mapped())
+        if entry is None or self.stale(entry):
+            return None
+        return Book.from_record(entry[1], Book.__slots__)
+
+    def search(self, by, query, page=1, page_size=10):
+        """Returns (books, total) of the books having all the words of
+        query in the fields of the filter, by isbn, paginated
+        Matches come from the postings, only the books of the page are
+        decoded. books is None if any of them is stale, to be fetched again
+        """
+        words = ['{0}:{1}'.format(by, word) for word in tokens(query)]
+        if not words:
+            return [], 0
+
+        mapped = self._mapped()
+        with self.lock:
+            new = set(self.new)
+            matches = sorted(set.intersection(*[self.index.get(word, set())
+                                                for word in words]))
+        total, listed = len(matches), iter(matches)
+        if mapped is not None:
+            postings = sorted((mapped.matching(word) for word in words),
+                              key=len)
+            found = set(postings[0])
+            for posting in postings[1:]:
+                found.intersection_update(posting)
+            # New books replace their records in the file
+            if len(found) < len(new):
+                found = set(number for number in found
+                            if mapped.isbn(number) not in new)
+            else:
+                found.difference_update(mapped.find(isbn13) for isbn13 in new)
+            # Records are sorted by isbn, only the ones up to the page are read
+            total += len(found)
+            listed = heapq.merge(listed, (mapped.isbn(number)
+                                          for number in sorted(found)))
+
+        start = (page - 1) * page_size
+        entries = [self._entry(isbn13, mapped) for isbn13
+                   in itertools.islice(listed, start, start + page_size)]
+        if any(entry is None or self.stale(entry) for entry in entries):
+            return None, total
+        return ([Book.from_record(record, Book.__slots__)
+                 for _, record in entries], total)
+
+    def stale(self, entry):
+        return time.time() - entry[0] > self.max_age
+
+    def save(self):
+        """Writes the new books along the ones in the file and maps it again
+        The file is read again with the lock held, other processes may have
+        replaced it, and the newest entry of each book and search is kept
+        """
+        with self.lock:
+            new = dict(self.new)
+            pages = dict(self.pages)
+        try:
+            with locked(self.path + '.lock'):
+                current = load(self.path)
+                merged = newest(dict(current or ()), new)
+                merged_pages = newest(current.pages if current else {}, pages)
+                write(self.path, Book.__slots__, sorted(merged.iteritems()),
+                      merged_pages)
+
+            # The previous map is closed once no reader uses it
+            self._mapped()
+            with self.lock:
+                for isbn13, entry in new.iteritems():
+                    if self.new.get(isbn13) is entry:
+                        del self.new[isbn13]
+                for key, entry in pages.iteritems():
+                    if self.pages.get(key) is entry:
+                        del self.pages[key]
+                self.index = {}
+                for isbn13, (_, record) in self.new.iteritems():
+                    for token in indexed(dict(zip(Book.__slots__, record))):
+                        self.index.setdefault(token, set()).add(isbn13)
+        finally:
+            with self.lock:
+                self.saving = False
+
+    def _mapped(self):
+        """The map of the file, mapped again if it was replaced since, by
+        this process or another one
+        """
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return self.file
+        identity = (stat.st_ino, stat.st_mtime)
+        if identity != self.identity:
+            mapped = load(self.path)
+            with self.lock:
+                self.file, self.identity = mapped, identity
+            return mapped
+        return self.file
+
+    def _entry(self, isbn13, mapped):
+        "(seen, record) of an isbn13, the newest one"
+        entry = self.new.get(isbn13)
+        if entry is None and mapped is not None:
+            number = mapped.find(isbn13)
+            if number is not None:
+                entry = mapped.load(number)
+        return entry
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+Health of the upstream providers: circuit breakers and latency stats.
+"""
+import threading
+from time import time
+from collections import deque
+
+import settings
+
+
+class CircuitBreaker(object):
+    """Stops calling a provider which is failing or too slow
+
+    CLOSED: calls go through and their outcome is recorded. When at least
+        half the `window` last calls failed or were slower than `slow_call`
+        seconds, the circuit opens.
+    OPEN: calls fail fast for `open_time` seconds, then one probe is let
+        through (HALF_OPEN).
+    HALF_OPEN: the circuit closes if the probe succeeds, or opens again.
+
+    The latencies of the last successful calls are kept too, by kind of
+    call, to know the usual latency of each one (see percentile).
+
+    >>> breaker = CircuitBreaker(window=20, slow_call=3, open_time=30)
+    >>> if breaker.allow():
+    ...     breaker.record(latency, ok, kind='lookup')
+    """
+
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+
+    # Failed or slow part of the window which opens the circuit
+    FAILURE_RATE = 0.5
+
+    # Latencies kept per kind of call to compute percentiles
+    SAMPLES = 200
+
+    def __init__(self, window=20, slow_call=3, open_time=30):
+        self.window = window
+        self.slow_call = slow_call
+        self.open_time = open_time
+        self.state = self.CLOSED
+        self.outcomes = deque(maxlen=window)  # True for the failed calls
+        self.latencies = {}  # kind of call -> deque of latencies
+        self.opened = None
+        self.probing = False
+        self.lock = threading.Lock()
+
+    def allow(self):
+        "Returns whether a call can be made now"
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN:
+                if time() - self.opened < self.open_time:
+                    return False
+                self.state = self.HALF_OPEN
+            if self.probing:
+                return False
+            self.probing = True
+            return True
+
+    def record(self, latency, ok=True, kind=None):
+        """Records the outcome of an allowed call of the given kind
+        A successful call slower than slow_call counts as failed
+        """
+        failed = not ok or latency > self.slow_call
+        with self.lock:
+            if ok:
+                if kind not in self.latencies:
+                    self.latencies[kind] = deque(maxlen=self.SAMPLES)
+                self.latencies[kind].append(latency)
+
+            if self.state == self.HALF_OPEN:  # the probe
+                self.probing = False
+                if failed:
+                    self._open()
+                else:
+                    self.state = self.CLOSED
+            elif self.state == self.CLOSED:
+                self.outcomes.append(failed)
+                if (len(self.outcomes) == self.window and
+                        sum(self.outcomes) >= self.window * self.FAILURE_RATE):
+                    self._open()
+
+    def release(self):
+        "Gives up an allowed call whose outcome says nothing of the provider"
+        with self.lock:
+            self.probing = False
+
+    def percentile(self, percent, kind=None):
+        """Returns the given percentile of the recent latencies of a kind of
+        call, None if few
+        """
+        with self.lock:
+            latencies = sorted(self.latencies.get(kind, ()))
+        if len(latencies) < settings.HEDGE_MIN_SAMPLES:
+            return None
+        return latencies[min(len(latencies) - 1,
+                             int(len(latencies) * percent / 100.0))]
+
+    def _open(self):
+        self.state = self.OPEN
+        self.probing = False
+        self.opened = time()
+        self.outcomes.clear()
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(name):
+    "Returns the shared circuit breaker for the given provider"
+    with _breakers_lock:
+        if name not in _breakers:
+            _breakers[name] = CircuitBreaker(settings.BREAKER_WINDOW,
+                                             settings.BREAKER_SLOW_CALL,
+                                             settings.BREAKER_OPEN_TIME)
+        return _breakers[name]
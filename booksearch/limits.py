@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""
+Rate and concurrency limits of the calls to each upstream provider.
+"""
+import heapq
+import itertools
+import threading
+from time import time
+
+import pool
+import settings
+
+
+class TokenBucket(object):
+    """Allows `rate` calls per second on average and bursts of `burst`
+
+    >>> bucket = TokenBucket(rate=10, burst=20)
+    >>> bucket.take()  # seconds to wait for a token, 0 if it was taken
+    0
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.updated = time()
+
+    def take(self):
+        "Takes a token if there's one and returns 0, or the seconds to wait"
+        now = time()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def drain(self):
+        "Drops the tokens left, the next calls wait for new ones"
+        self.tokens = 0
+        self.updated = time()
+
+
+class Limiter(object):
+    """Rate limit and adaptive concurrency limit of a provider
+
+    Calls wait for a token of the TokenBucket and for a free slot among
+    `limit` concurrent ones. The limit adapts between minimum and maximum
+    (AIMD): it's cut by BACKOFF when upstream throttles (429/503) and grows
+    by one every `limit` calls with a healthy latency, within TOLERANCE
+    times the average. Waiting calls go in order of priority (pool.USER
+    first) and arrival.
+
+    >>> limiter = Limiter(rate=10, burst=20, minimum=1, maximum=8)
+    >>> if limiter.acquire(timeout=5):
+    ...     start = time()
+    ...     fetch()
+    ...     limiter.release(time() - start)
+    """
+
+    BACKOFF = 0.5
+    TOLERANCE = 2.0
+
+    def __init__(self, rate=None, burst=1, minimum=1, maximum=8):
+        self.bucket = TokenBucket(rate, burst) if rate else None
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = float(maximum)
+        self.active = 0
+        self.latency = None  # moving average of the successful calls
+        self.waiting = []  # heap of (priority, arrival)
+        self.arrivals = itertools.count()
+        self.condition = threading.Condition()
+
+    def acquire(self, timeout=None, priority=None):
+        """Waits for a token and a free slot, returns whether it got them
+        before timeout. priority is the one of the current thread by default
+        """
+        if priority is None:
+            priority = pool.current_priority()
+        expires = None if timeout is None else time() + timeout
+        turn = (priority, next(self.arrivals))
+
+        with self.condition:
+            heapq.heappush(self.waiting, turn)
+            try:
+                while True:
+                    wait = None
+                    first = self.waiting[0] == turn
+                    if first and self.active < int(self.limit):
+                        wait = self.bucket.take() if self.bucket else 0
+                        if not wait:
+                            self.active += 1
+                            return True
+
+                    if expires is not None:
+                        left = expires - time()
+                        if left <= 0:
+                            return False
+                        wait = left if wait is None else min(wait, left)
+                    self.condition.wait(wait)
+            finally:
+                self.waiting.remove(turn)
+                heapq.heapify(self.waiting)
+                self.condition.notify_all()
+
+    def release(self, latency=None, throttled=False):
+        """Frees the slot of a finished call
+        latency is None for failed calls, which don't change the limit
+        """
+        with self.condition:
+            self.active -= 1
+            if throttled:
+                self.limit = max(self.minimum, self.limit * self.BACKOFF)
+                if self.bucket:
+                    self.bucket.drain()
+            elif latency is not None:
+                if self.latency is None:
+                    self.latency = latency
+                if latency <= self.latency * self.TOLERANCE:
+                    self.limit = min(self.maximum, self.limit + 1 / self.limit)
+                self.latency = 0.9 * self.latency + 0.1 * latency
+            self.condition.notify_all()
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(name):
+    "Returns the shared limiter for the given provider, creating it once"
+    with _limiters_lock:
+        if name not in _limiters:
+            rate, burst = settings.RATE_LIMITS.get(name, (None, 1))
+            minimum, maximum = settings.CONCURRENCY.get(
+                name, (1, settings.POOL_SIZES.get(name, settings.POOL_SIZE)))
+            _limiters[name] = Limiter(rate, burst, minimum, maximum)
+        return _limiters[name]
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+"""
+Counters and histograms of the hot paths, exposed in the Prometheus text
+format, and the optional log of the requests.
+"""
+import sys
+import time
+import Queue
+import bisect
+import threading
+from contextlib import contextmanager
+from collections import OrderedDict
+
+import settings
+
+
+class Metric(object):
+    """Values of a metric for each combination of labels
+    Updates take a single lock, series are created on first use
+    """
+
+    TYPE = None
+
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        self.series = {}  # sorted label items -> value
+        self.lock = threading.Lock()
+
+    def exposition(self):
+        "Lines of the metric in the Prometheus text format"
+        lines = ['# HELP {0} {1}'.format(self.name, self.description),
+                 '# TYPE {0} {1}'.format(self.name, self.TYPE)]
+        with self.lock:
+            series = sorted(self.series.items())
+        for labels, value in series:
+            lines.extend(self.samples(labels, value))
+        return lines
+
+    def samples(self, labels, value):
+        return [sample(self.name, labels, value)]
+
+
+class Counter(Metric):
+    """Monotonic count
+
+    >>> requests = Counter('requests_total', 'Requests made')
+    >>> requests.inc(provider='google')
+    """
+
+    TYPE = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.series[key] = self.series.get(key, 0) + amount
+
+
+class Histogram(Metric):
+    """Distribution of observed values in fixed buckets
+
+    >>> seconds = Histogram('call_seconds', 'Duration of the calls')
+    >>> with seconds.time(provider='isbndb'):
+    ...     call()
+    """
+
+    TYPE = 'histogram'
+
+    # Upper bounds in seconds
+    BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+               0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, name, description, buckets=BUCKETS):
+        super(Histogram, self).__init__(name, description)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        bucket = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.series.get(key)
+            if counts is None:
+                # Count of each bucket and the +Inf one, then the sum
+                counts = self.series[key] = [0] * (len(self.buckets) + 2)
+            counts[bucket] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        "Observes the seconds spent in the block"
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - start, **labels)
+
+    def samples(self, labels, counts):
+        lines, total = [], 0
+        for bound, count in zip(self.buckets + ('+Inf',), counts):
+            total += count
+            lines.append(sample(self.name + '_bucket',
+                                labels + (('le', str(bound)),), total))
+        lines.append(sample(self.name + '_sum', labels, counts[-1]))
+        lines.append(sample(self.name + '_count', labels, total))
+        return lines
+
+
+def sample(name, labels, value):
+    "A line of the text format"
+    if labels:
+        name += '{' + ','.join('{0}="{1}"'.format(
+            key, str(label).replace('\\', '\\\\').replace('"', '\\"')
+                           .replace('\n', '\\n'))
+            for key, label in labels) + '}'
+    return '{0} {1}'.format(name, repr(float(value)))
+
+
+_metrics = OrderedDict()
+_metrics_lock = threading.Lock()
+
+
+def _register(cls, name, description, *args):
+    with _metrics_lock:
+        if name not in _metrics:
+            _metrics[name] = cls(name, description, *args)
+        return _metrics[name]
+
+
+def counter(name, description):
+    "Returns the Counter of the given name, creating it once"
+    return _register(Counter, name, description)
+
+
+def histogram(name, description, buckets=Histogram.BUCKETS):
+    "Returns the Histogram of the given name, creating it once"
+    return _register(Histogram, name, description, buckets)
+
+
+def exposition():
+    "All the metrics in the Prometheus text format"
+    with _metrics_lock:
+        metrics = _metrics.values()
+    return '\n'.join(line for metric in metrics
+                     for line in metric.exposition()) + '\n'
+
+
+class AsyncLog(object):
+    """Writes lines to stdout from a background thread
+    Lines are queued without waiting, and dropped if the queue is full
+    """
+
+    def __init__(self, size=10000):
+        self.queue = Queue.Queue(size)
+        self.thread = None
+        self.lock = threading.Lock()
+        self.dropped = counter('booksearch_log_dropped_total',
+                               'Log lines dropped because the log lagged')
+
+    def write(self, line):
+        if self.thread is None:
+            self._start()
+        try:
+            self.queue.put_nowait(line)
+        except Queue.Full:
+            self.dropped.inc()
+
+    def _start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run,
+                                               name='log')
+                self.thread.daemon = True
+                self.thread.start()
+
+    def _run(self):
+        while True:
+            line = self.queue.get()
+            sys.stdout.write(line + '\n')
+            if self.queue.empty():
+                sys.stdout.flush()
+
+
+_log = AsyncLog(settings.LOG_QUEUE_SIZE)
+
+
+def log(message, *args):
+    "Logs the message formatted with args if LOG_REQUESTS is set"
+    if settings.LOG_REQUESTS:
+        _log.write(message.format(*args))
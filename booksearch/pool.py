@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+"""
+Bounded pools of reusable worker threads used to run requests in parallel,
+and a scheduler of delayed calls.
+"""
+import os
+import time
+import heapq
+import Queue
+import select
+import itertools
+import threading
+import traceback
+from contextlib import contextmanager
+
+import tracing
+import settings
+
+
+# Priorities of the queued tasks, lower ones run first
+USER, BULK, PREFETCH = 0, 1, 2
+
+# Pools running background work, their tasks are always PREFETCH and are
+# not part of the trace of the request which submitted them
+BACKGROUND_POOLS = ('prefetch', 'refresh', 'catalog')
+
+
+class Task(object):
+    """A function call submitted to a WorkerPool
+    The outcome can be checked in .result or .error once it's done
+    It runs within the trace span of its submitter, if any
+    """
+
+    def __init__(self, fn, args=(), kwargs=None, priority=USER, span=None):
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs or {}
+        self.priority = priority
+        self.span = span
+        self.result = None
+        self.error = None
+        self.finished = threading.Event()
+        self.watchers = []  # queues to put the task in once finished
+        self.lock = threading.Lock()
+
+    def run(self):
+        "Calls the function and flags the task as finished"
+        try:
+            self.result = self.fn(*self.args, **self.kwargs)
+        except Exception, err:
+            self.error = err
+            traceback.print_exc()
+        finally:
+            with self.lock:
+                self.finished.set()
+                watchers, self.watchers = self.watchers, []
+            for queue in watchers:
+                queue.put(self)
+
+    def notify(self, queue):
+        "Puts the task in queue once it's finished, right away if it is"
+        with self.lock:
+            if not self.finished.is_set():
+                self.watchers.append(queue)
+                return
+        queue.put(self)
+
+    def wait(self, timeout=None):
+        "Waits for the task to finish, returns whether it did"
+        return wait([self], timeout)
+
+    @property
+    def done(self):
+        return self.finished.is_set()
+
+
+def current_priority():
+    "Priority of the work done by the current thread, USER by default"
+    return getattr(WorkerPool.local, 'priority', USER)
+
+
+@contextmanager
+def priority(level):
+    """Runs the block at the given priority, the tasks submitted from it
+    (and the ones they submit) are queued with it
+    """
+    previous = current_priority()
+    WorkerPool.local.priority = level
+    try:
+        yield
+    finally:
+        WorkerPool.local.priority = previous
+
+
+class WorkerPool(object):
+    """Pool of at most `size` daemon threads consuming a task queue
+    Threads are started on demand and live on to run further tasks
+    Queued tasks run by priority, the submitter's one unless the pool
+    has its own, and then in submission order
+    """
+
+    # Pool owning the current thread and its priority, if any
+    local = threading.local()
+
+    def __init__(self, name, size, priority=None):
+        self.name = name
+        self.size = size
+        self.priority = priority
+        self.queue = Queue.PriorityQueue()
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+        self.workers = 0
+        self.idle = 0  # workers waiting for a task not yet submitted
+        self.backlog = 0  # queued tasks no worker is waiting for
+
+    def submit(self, fn, *args, **kwargs):
+        "Schedules fn(*args, **kwargs) and returns its Task"
+        level = self.priority
+        if level is None:
+            level = current_priority()
+        span = None if self.name in BACKGROUND_POOLS else tracing.current()
+        task = Task(fn, args, kwargs, level, span)
+
+        # A worker waiting on its own pool could starve it, run it in place
+        if getattr(self.local, 'pool', None) is self:
+            task.run()
+            return task
+
+        # Each task is either taken by an idle worker or left in the backlog,
+        # which starts a new worker while there's room for it
+        with self.lock:
+            if self.idle:
+                self.idle -= 1
+            else:
+                self.backlog += 1
+            if self.backlog and self.workers < self.size:
+                self.workers += 1
+                worker = threading.Thread(target=self._work,
+                                          name='{0}-{1}'.format(self.name,
+                                                                self.workers))
+                worker.setDaemon(True)  # Avoid zombie threads when exiting
+                worker.start()
+
+        self.queue.put((task.priority, next(self.counter), task))
+        return task
+
+    def _work(self):
+        "Worker thread main loop"
+        self.local.pool = self
+        while True:
+            with self.lock:
+                if self.backlog:
+                    self.backlog -= 1
+                else:
+                    self.idle += 1
+            _, _, task = self.queue.get()
+            with priority(task.priority), tracing.activated(task.span):
+                task.run()
+
+
+class Timer(object):
+    "A call scheduled by a Scheduler, it doesn't run once cancelled"
+
+    def __init__(self, fn, args):
+        self.fn = fn
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class Scheduler(object):
+    """Runs calls after a delay from a single daemon thread
+    The thread sleeps in select until the next call is due or a sooner one
+    is scheduled, as timed waits on locks and queues poll in Python 2
+    Calls must be short, longer work is submitted to a pool
+
+    >>> timer = Scheduler().call_later(0.2, pool.submit, hedge)
+    >>> timer.cancel()
+    """
+
+    def __init__(self):
+        self.timers = []  # heap of (due time, number, Timer)
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.wakeup, self.waker = os.pipe()
+
+    def call_later(self, delay, fn, *args):
+        "Calls fn(*args) in delay seconds, returns its Timer"
+        timer = Timer(fn, args)
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run,
+                                               name='scheduler')
+                self.thread.setDaemon(True)
+                self.thread.start()
+            heapq.heappush(self.timers, (time.time() + delay,
+                                         next(self.counter), timer))
+            sooner = self.timers[0][2] is timer
+        if sooner:
+            os.write(self.waker, '.')
+        return timer
+
+    def _run(self):
+        "Scheduler thread main loop"
+        while True:
+            due, timeout = [], None
+            with self.lock:
+                now = time.time()
+                while self.timers and (self.timers[0][0] <= now or
+                                       self.timers[0][2].cancelled):
+                    due.append(heapq.heappop(self.timers)[2])
+                if self.timers:
+                    timeout = self.timers[0][0] - now
+
+            for timer in due:
+                if not timer.cancelled:
+                    try:
+                        timer.fn(*timer.args)
+                    except Exception:
+                        traceback.print_exc()
+            if due:
+                continue
+
+            readable, _, _ = select.select([self.wakeup], [], [], timeout)
+            if readable:
+                os.read(self.wakeup, 512)
+
+
+_scheduler = Scheduler()
+
+
+def call_later(delay, fn, *args):
+    "Calls fn(*args) in delay seconds from the shared Scheduler"
+    return _scheduler.call_later(delay, fn, *args)
+
+
+def wait(tasks, timeout=None):
+    """Waits for the tasks to finish, up to timeout seconds, returns whether
+    they all did. The wait isn't polled, the tasks and a timer of the
+    Scheduler wake the waiter through a queue
+    """
+    tasks = [task for task in tasks if not task.done]
+    if not tasks:
+        return True
+    if timeout is not None and timeout <= 0:
+        return False
+
+    finished = Queue.Queue()
+    for task in tasks:
+        task.notify(finished)
+    timer = None if timeout is None else call_later(timeout, finished.put,
+                                                    None)
+    try:
+        for _ in tasks:
+            if finished.get() is None:
+                return False
+        return True
+    finally:
+        if timer is not None:
+            timer.cancel()
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(name):
+    "Returns the shared pool for the given provider, creating it once"
+    with _pools_lock:
+        if name not in _pools:
+            size = settings.POOL_SIZES.get(name, settings.POOL_SIZE)
+            level = PREFETCH if name in BACKGROUND_POOLS else None
+            _pools[name] = WorkerPool(name, size, level)
+        return _pools[name]
@@ -3,15 +3,39 @@
 Book search
 """
 
+import json
+import time
+import hashlib
+import threading
 from collections import OrderedDict
 
+import pool
+import metrics
+import tracing
+import settings
+from cache import ObjectCache
+from catalog import Catalog, normalize
+from api import Deadline
+from api import APIRequest
+from api import ISBNdbRequest
+from api import to_isbn13
 from api import BookRequest
 from api import AuthorRequest
 from api import APIRequestError
+from api import APITimeoutError
+from api import APIThrottledError
 from api import SubjectRequest
 from api import PublisherRequest
 
 
+SEARCH_CACHE_REQUESTS = metrics.counter(
+    'booksearch_search_cache_requests_total',
+    'Lookups of finished searches by result (hit or miss)')
+CATALOG_REQUESTS = metrics.counter(
+    'booksearch_catalog_requests_total',
+    'Searches answered from the local catalog by result (hit or miss)')
+
+
 class SearchError(Exception):
     "Search Exception class"
     pass
@@ -24,14 +48,45 @@ class Search(object):
 
     The filters 'author', 'publisher' and 'subject' requires more
      than one API call and currently represents two searches.
+     Their pages hold the books of IDS_PER_PAGE authors/publishers/subjects
+     and total_results counts the authors/publishers/subjects found.
     """
 
     FILTERS = ('isbn', 'title', 'author', 'publisher', 'subject', 'book_id')
 
+    # Rounds of book listings made to fill a page when ids have no books
+    MAX_ROUNDS = 3
+
+    # Speculative work is capped globally, prefetches beyond it are dropped
+    prefetching = threading.BoundedSemaphore(settings.PREFETCH_MAX)
+
+    # Finished searches, the front tier of APIRequest.cache. Their books are
+    # shared by whoever asks for them again, so they must not be modified
+    finished = ObjectCache(settings.SEARCH_CACHE_SIZE,
+                           settings.SEARCH_CACHE_TIME)
+
+    # Every book seen, to answer offline-first, see catalog.py
+    catalog = Catalog(settings.CATALOG_PATH) if settings.CATALOG_PATH else None
+
+    # Filters answered offline. Pages of two level searches aren't, their
+    # total_results counts the first level ids, not the books
+    OFFLINE_FILTERS = ('isbn', 'title')
+
+    # What's kept of a finished search
+    RESULT = ('books', 'results', 'total_pages', 'total_results',
+              'more_pages', 'fetched')
+
     def __init__(self, by, query, page=1):
         if by not in self.FILTERS:
             raise SearchError("Invalid filter '{0}'".format(by))
 
+        # Isbns are always searched as ISBN-13
+        if by == 'isbn':
+            isbn13 = to_isbn13(query)
+            if isbn13 is None:
+                raise SearchError("Invalid isbn '{0}'".format(query))
+            query = isbn13
+
         self.by = by
         self.query = query
         self.page = page
@@ -39,20 +94,155 @@ class Search(object):
         self.results = None
         self.total_pages = None
         self.total_results = None
+        self.more_pages = False
+        self.partial = False
+        self.enrich = True
+        self.complete = False  # books with all their Google data
+        self.fetched = []  # fetch time of each listing shown
+        self.deadline = Deadline()
+
+    def get(self, timeout=None, prefetch=settings.PREFETCH, enrich=True):
+        """Searches for the books
+        The search answers within timeout seconds (if given) with the data
+        fetched until then, flagging the search as partial
+        If prefetch, the next page is fetched in background when there's one
+        If not enrich, the books are listed without the Google data, which
+        can be fetched afterwards with enrichments(), unless the search
+        comes back complete anyway
+        Complete searches are kept for SEARCH_CACHE_TIME, asking for them
+        again takes a single lookup in Search.finished
+        """
+        if self.books is None:
+            result = Search.finished.get(self.key)
+            SEARCH_CACHE_REQUESTS.inc(result='miss' if result is None
+                                      else 'hit')
+            if result is not None:
+                for name, value in zip(self.RESULT, result):
+                    setattr(self, name, value)
+                self.complete = True
+                return self
 
-    def get(self):
-        "Searches for the books"
         if self.books is None:
+            page = self.page
+            self.enrich = enrich
+            self.deadline = Deadline(timeout)
+            offline = self._get_offline()
             method = '_get_by_' + self.by
             try:
-                self.books = self.__getattribute__(method)()
+                with tracing.span('Search', by=self.by, query=self.query,
+                                  page=page, offline=offline):
+                    if not offline:
+                        self.books = self.__getattribute__(method)()
             except APIRequestError, err:
                 raise SearchError(err)
 
-        self.results = len(self.books)
+            self.results = len(self.books)
+            self.partial = self.partial or any(getattr(book, 'missing', None)
+                                               for book in self.books)
+            self.complete = offline or (enrich and not self.partial)
+            if self.complete:
+                self._keep(catalog=not offline)
+
+            # A partial answer means upstream is struggling, don't add load
+            if prefetch and self.more_pages and not self.partial:
+                self.prefetch(page + 1)
 
         return self
 
+    def _keep(self, catalog=True):
+        """Keeps a complete search in Search.finished and, if catalog, its
+        books and page in Search.catalog
+        """
+        Search.finished.set(self.key, tuple(getattr(self, name)
+                                            for name in self.RESULT))
+        if Search.catalog is not None and catalog:
+            Search.catalog.add(
+                self.books,
+                self.key if self.by in self.OFFLINE_FILTERS else None,
+                (self.total_results, self.total_pages, self.more_pages))
+
+    @property
+    def key(self):
+        "The search as (by, normalized query, page)"
+        return (self.by, normalize(self.query), self.page)
+
+    def prefetch(self, page):
+        """Fetchs a page of this search in the low priority 'prefetch' pool
+        so it's already cached when the user asks for it
+        Returns the Task, or None if too many prefetches are in progress
+        """
+        if not Search.prefetching.acquire(False):
+            return None
+
+        def fetch():
+            try:
+                Search(self.by, self.query, page).get(
+                    timeout=settings.HTTP_TIMEOUT, prefetch=False)
+            except SearchError:
+                pass  # it will be retried if the user asks for it
+            finally:
+                Search.prefetching.release()
+
+        return pool.get_pool('prefetch').submit(fetch)
+
+    @property
+    def last_modified(self):
+        "Time of the newest listing in the search, None if unknown"
+        fetched = filter(None, self.fetched)
+        return max(fetched) if fetched else None
+
+    @property
+    def max_age(self):
+        "Seconds until the oldest listing in the search expires in cache"
+        fetched = filter(None, self.fetched)
+        if not fetched:
+            return 0
+        return max(0, int(min(fetched) + settings.CACHE_TIME - time.time()))
+
+    def enrichments(self, timeout=None):
+        """Completes the books of a search made without enrich, yielding
+        each book as soon as its Google data arrives
+        Once they all have it the search is kept as complete, like get()
+        does, so asking for it again doesn't list it again
+        """
+        if self.complete:
+            for book in self.books:
+                yield book
+            return
+
+        self.deadline = Deadline(timeout)
+        for book in BookRequest.iter_enriched(self.books, self.deadline):
+            yield book
+
+        self.partial = self.partial or any(getattr(book, 'missing', None)
+                                           for book in self.books)
+        if not self.partial:
+            self.complete = True
+            self._keep()
+
+    def _get_offline(self):
+        """Answers from the catalog if CATALOG_OFFLINE_FIRST, returns whether
+        it could. Searches by isbn need the book, searches by title the page
+        as upstream listed it, all of them seen within CATALOG_MAX_AGE
+        """
+        catalog = Search.catalog
+        if (catalog is None or not settings.CATALOG_OFFLINE_FIRST or
+                self.by not in self.OFFLINE_FILTERS):
+            return False
+
+        found = catalog.page(self.key)
+        if found is None and self.by == 'isbn' and self.page == 1:
+            book = catalog.get(self.query)
+            if book is not None:
+                found = ([book], (1, 1, False))
+
+        CATALOG_REQUESTS.inc(result='miss' if found is None else 'hit')
+        if found is None:
+            return False
+        self.books, totals = found
+        self.total_results, self.total_pages, self.more_pages = totals
+        return True
+
     def _get_by_isbn(self):
         return self._get_direct(self.by)
 
@@ -65,29 +255,32 @@ class Search(object):
     def _get_by_author(self):
         """Searchs for the author and then for the books by author_id
 
-        Only 3 books from each author is listed.
+        Only BOOKS_PER_ID books from each author are listed.
         """
         return self._2level_search(AuthorRequest, 'person_id')
 
     def _get_by_publisher(self):
         """Searchs for the publisher and then for the books by publisher_id
 
-        Only 3 books from each publisher is listed.
+        Only BOOKS_PER_ID books from each publisher are listed.
         """
         return self._2level_search(PublisherRequest, 'publisher_id')
 
     def _get_by_subject(self):
         """Searchs for the subject and then for the books by subject_id
 
-        Only 3 books from each subject is listed.
+        Only BOOKS_PER_ID books from each subject are listed.
         """
         return self._2level_search(SubjectRequest, 'subject_id')
 
     def _get_direct(self, field):
         "Get a list of books searching directly on the server"
-        req = BookRequest(field=field, value=self.query, page=self.page).get()
+        req = BookRequest(field=field, value=self.query, page=self.page,
+                          enrich=self.enrich, deadline=self.deadline).get()
         self.total_pages = req.total_pages
         self.total_results = req.total_results
+        self.more_pages = req.more_pages
+        self.fetched.append(req.fetched)
         return req.books
 
     def _2level_search(self, firstreq, bookfield):
@@ -95,22 +288,84 @@ class Search(object):
         needs to search for the author/publisher/subject first
         and then return the results.
 
-        The pagination then it's not straightforward and just
-        3 books per each first level subject is displayed.
+        Each page lists the books of the next IDS_PER_PAGE first level ids
+        which have any. The page starts where the previous one stopped, as
+        ids without books are skipped, and remembers where it stopped itself
+        so only the first level pages and books of this page are fetched.
         """
-        self.page = (self.page - 1) / 3 + 1  # fake pagination
-        req = firstreq(name=self.query, page=self.page).get()
-        self.total_pages = req.total_pages * 3
-        self.total_results = req.total_results * 3
-
-        # Get the 3 first books for the 3 first authors in the search
-        requests = [BookRequest(field=bookfield, value=data_id)
-                    for data_id in req.data[:3 * self.page]]
-        BookRequest.distpach(requests)
+        per_page = settings.IDS_PER_PAGE
+        start = self._cursor(self.page)
+        if start is None:  # previous page not seen yet, assume no skips
+            start = (self.page - 1) * per_page
 
         books = OrderedDict()  # remove duplicates maintaining order
-        for r in requests:
-            if r.data is not None:
-                books.update({d: None for d in r.data[:3]})
+        cursor, found, total = start, 0, 0
+        for _ in range(self.MAX_ROUNDS):
+            if self.deadline.expired:  # answer with the books listed so far
+                self.partial = True
+                break
+            ids, total = self._first_level_ids(firstreq, cursor,
+                                               per_page - found)
+            requests = [BookRequest(field=bookfield, value=data_id,
+                                    enrich=False, deadline=self.deadline)
+                        for data_id in ids]
+            BookRequest.distpach(requests, self.deadline)
+
+            pending = False
+            for r in requests:
+                # out of time or throttled, next page resumes from here
+                if not r.done or isinstance(r.task.error, (APITimeoutError,
+                                                           APIThrottledError)):
+                    pending = self.partial = True
+                    break
+                cursor += 1
+                self.fetched.append(r.fetched)
+                if r.data:
+                    found += 1
+                    for book in r.data[:settings.BOOKS_PER_ID]:
+                        books.setdefault(book.book_id, book)
+
+            if not ids or pending or found >= per_page or cursor >= total:
+                break
+
+        self._set_cursor(self.page + 1, cursor)
+        remaining = max(total - cursor, 0)
+        self.total_results = total
+        self.total_pages = self.page + (remaining + per_page - 1) // per_page
+        self.more_pages = remaining > 0
+
+        if not self.enrich:
+            return list(books.values())
+        return BookRequest.enrich_books(list(books.values()), self.deadline)
+
+    def _first_level_ids(self, firstreq, offset, count):
+        """Returns (ids, total) with count first level ids from offset
+        and the total number of them, fetching only the pages needed
+        """
+        ids, total = [], 0
+        while len(ids) < count:
+            page, index = divmod(offset, ISBNdbRequest.PAGE_SIZE)
+            req = firstreq(name=self.query, page=page + 1,
+                           deadline=self.deadline).get()
+            total = req.total_results or 0
+            chunk = (req.data or [])[index:index + count - len(ids)]
+            if not chunk:
+                break
+            ids.extend(chunk)
+            offset += len(chunk)
+        return ids, total
+
+    def _cursor_key(self, page):
+        digest = hashlib.sha1(json.dumps([self.by, normalize(self.query),
+                                          page]))
+        return 'cursor:' + digest.hexdigest()
+
+    def _cursor(self, page):
+        "Returns the first level offset where page starts, if known"
+        if page == 1:
+            return 0
+        return APIRequest.cache.get(self._cursor_key(page))
 
-        return list(books.keys())
+    def _set_cursor(self, page, offset):
+        APIRequest.cache.set(self._cursor_key(page), offset,
+                             settings.CACHE_TIME)
@@ -1,15 +1,131 @@
 # max number of items in cache
 CACHE_THRESHOLD = 1000
 
+# max number of bytes of cached data
+CACHE_MAX_BYTES = 64 * 1024 * 1024
+
 # cache invalidation time (1h)
 CACHE_TIME = 3600
 
+# an expired entry with results is still served during this time while it's
+# refreshed in background (10 min)
+CACHE_GRACE_TIME = 600
+
+# cache time for calls without results (5 min) and for failed calls (30 s)
+CACHE_EMPTY_TIME = 300
+CACHE_ERROR_TIME = 30
+
+# cache backend: 'memory' (per process), 'sqlite' (shared by the processes of
+# a host) or 'memcached' (networked), see cache.py
+CACHE_BACKEND = 'memory'
+CACHE_OPTIONS = {'threshold': CACHE_THRESHOLD, 'max_bytes': CACHE_MAX_BYTES}
+#CACHE_BACKEND = 'sqlite'
+#CACHE_OPTIONS = {'path': '/var/tmp/booksearch-cache.sqlite', 'threshold': 100000}
+#CACHE_BACKEND = 'memcached'
+#CACHE_OPTIONS = {'servers': ['127.0.0.1:11211']}
+
 # Google Books API Key
 GOOGLE_BOOKS_ACCESS_KEY = ''
 
-# Amazon Services Public and Private Key
+# Amazon Services Public and Private Key, when set the covers missing in
+# Google Books are looked up in Amazon
 AMAZON_ACCESS_KEY = ''
 AMAZON_SECRET_ACCESS_KEY = ''
 
 # ISBNdb access token
 ISBNdb_ACCESS_KEY = '';
+
+# Worker threads shared by all the requests to an upstream provider
+POOL_SIZE = 8
+POOL_SIZES = {'isbndb': 8, 'google': 16, 'amazon': 4, 'refresh': 2,
+              'prefetch': 2, 'hedge': 16, 'catalog': 1}
+
+# Upstream rate limits per provider: (calls per second, burst)
+RATE_LIMITS = {'isbndb': (10, 20), 'google': (20, 40), 'amazon': (1, 1)}
+
+# Concurrent calls per provider (minimum, maximum), the limit backs off when
+# upstream throttles (429/503) and grows back while latency is healthy
+CONCURRENCY = {'isbndb': (1, 8), 'google': (2, 16), 'amazon': (1, 4)}
+
+# Circuit breaker per provider: it opens when half of the last BREAKER_WINDOW
+# calls failed or took more than BREAKER_SLOW_CALL seconds, then calls fail
+# fast for BREAKER_OPEN_TIME seconds until a probe call succeeds
+BREAKER_WINDOW = 20
+BREAKER_SLOW_CALL = 3
+BREAKER_OPEN_TIME = 30
+
+# Calls to these providers slower than the HEDGE_PERCENTILE of their latency
+# (once HEDGE_MIN_SAMPLES are known) are duplicated, the first answer wins
+HEDGE_PROVIDERS = ('google',)
+HEDGE_PERCENTILE = 95
+HEDGE_MIN_SAMPLES = 20
+
+# Idle keep-alive connections kept per upstream host (overridable per host)
+HTTP_POOL_SIZE = 10
+HTTP_POOL_SIZES = {'www.googleapis.com': 16}
+
+# Transport of the upstream calls: 'http', 'record' (http saving every
+# response in a fixtures directory) or 'replay' (answering with the saved
+# responses, with an injected average latency and error rate). 'synthetic'
+# makes up the responses without a fixture (see standin.py)
+TRANSPORT = 'http'
+TRANSPORT_OPTIONS = {}
+#TRANSPORT = 'record'
+#TRANSPORT_OPTIONS = {'path': 'fixtures'}
+#TRANSPORT = 'replay'
+#TRANSPORT_OPTIONS = {'path': 'fixtures', 'latency': 0.1, 'error_rate': 0.01}
+#TRANSPORT = 'http'
+#TRANSPORT_OPTIONS = {'upstream': 'http://127.0.0.1:8001'}  # stand-in server
+
+# Log a line per upstream request to stdout, written in background, and the
+# lines waiting to be written (more are dropped)
+LOG_REQUESTS = True
+LOG_QUEUE_SIZE = 10000
+
+# Requests slower than TRACE_SLOW_TIME seconds are kept with their trace,
+# the last TRACE_SLOW_SIZE of them, and shown at /admin/slow
+TRACE_SLOW_TIME = 3
+TRACE_SLOW_SIZE = 50
+
+# Allow profiling any request with ?profile=1, sampling its threads every
+# PROFILE_INTERVAL seconds. Profiled requests are kept as the slow ones
+PROFILE_REQUESTS = False
+PROFILE_INTERVAL = 0.005
+
+# Finished searches kept in process, ready to be shown again, and for how
+# many seconds. The upstream responses behind them stay CACHE_TIME
+SEARCH_CACHE_SIZE = 500
+SEARCH_CACHE_TIME = 60
+
+# Local catalog file of every book seen (see catalog.py), None to disable
+# it. New books are written every CATALOG_SAVE_EVERY. With
+# CATALOG_OFFLINE_FIRST searches by isbn or title are answered from it when
+# it has the page as listed upstream, seen within CATALOG_MAX_AGE seconds
+CATALOG_PATH = None
+#CATALOG_PATH = '/var/tmp/booksearch-catalog'
+CATALOG_SAVE_EVERY = 1000
+CATALOG_OFFLINE_FIRST = False
+CATALOG_MAX_AGE = 7 * 24 * 3600
+
+# Seconds a search may take before answering with the data fetched so far
+SEARCH_TIMEOUT = 5
+
+# Seconds to wait for a single upstream call
+HTTP_TIMEOUT = 10
+
+# Isbns combined in a single Google Books search
+GOOGLE_BATCH_SIZE = 10
+
+# Searches by author, publisher or subject list the books of IDS_PER_PAGE
+# authors/publishers/subjects per page, BOOKS_PER_ID books of each one
+IDS_PER_PAGE = 3
+BOOKS_PER_ID = 3
+
+# Fetch the next page of a search in background so it comes from cache when
+# asked for, at most PREFETCH_MAX prefetches are queued or running at once
+PREFETCH = True
+PREFETCH_MAX = 4
+
+# Bulk lookups: isbns looked up at a time and max isbns per HTTP request
+BULK_CHUNK_SIZE = 100
+BULK_MAX_ISBNS = 10000
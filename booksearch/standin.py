@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+"""
+Stand-in server for the upstream providers, for offline runs and benchmarks.
+
+It answers with the responses recorded by the 'record' transport and makes
+up deterministic ones (synthetic) for the urls without a fixture.
+
+    $ python standin.py --port 8001 --fixtures fixtures --latency 0.1
+
+and in settings.py:
+
+    TRANSPORT_OPTIONS = {'upstream': 'http://127.0.0.1:8001'}
+"""
+import re
+import json
+import hashlib
+import argparse
+import urlparse
+from xml.sax.saxutils import quoteattr
+
+from werkzeug.wrappers import Request, Response
+from werkzeug.serving import run_simple
+
+from api import CREDENTIALS
+from transport import ReplayTransport, TransportError
+
+# Books listed by the synthetic searches, and ids by the ones of authors,
+# publishers and subjects. Some of them have no books
+MAX_BOOKS = 40
+MAX_IDS = 30
+
+ISBNDB_LISTS = {
+    'books': ('BookList', 'BookData', 'book_id'),
+    'authors': ('AuthorList', 'AuthorData', 'person_id'),
+    'publisher': ('PublisherList', 'PublisherData', 'publisher_id'),
+    'subjects': ('SubjectList', 'SubjectData', 'subject_id'),
+    'categories': ('CategoryList', 'CategoryData', 'category_id'),
+}
+
+AMAZON_NS = 'http://webservices.amazon.com/AWSECommerceService/2011-08-01'
+
+
+def number(*values):
+    "Stable number made up from values"
+    return int(hashlib.md5(repr(values)).hexdigest()[:8], 16)
+
+
+def make_isbn(n):
+    "ISBN-10 of the given number"
+    digits = '{0:09d}'.format(n % 10 ** 9)
+    check = (11 - sum((10 - i) * int(d) for i, d in enumerate(digits))
+             % 11) % 11
+    return digits + ('X' if check == 10 else str(check))
+
+
+def synthetic(url):
+    """Makes up the response of an upstream url, returns (status, body)
+    The same url gets always the same response
+    """
+    parts = urlparse.urlsplit(url)
+    args = dict(urlparse.parse_qsl(parts.query, True))
+    path = parts.path
+
+    match = re.match(r'^/api/(\w+)\.xml$', path)
+    if match and match.group(1) in ISBNDB_LISTS:
+        return 200, isbndb_list(match.group(1), args.get('index1'),
+                                args.get('value1', ''),
+                                int(args.get('page_number', 1)))
+    if path == '/books/v1/volumes':
+        isbns = re.findall(r'isbn:([0-9Xx]+)', args.get('q', ''))
+        items = [google_volume(isbn) for isbn in isbns]
+        return 200, json.dumps({'kind': 'books#volumes',
+                                'totalItems': len(items), 'items': items})
+    if path.startswith('/books/v1/volumes/'):
+        return 200, json.dumps(google_volume(path.rsplit('/', 1)[1][1:]))
+    if path == '/onca/xml':
+        return 200, amazon_items(args.get('ItemId', '').split(','))
+    return 404, ''
+
+
+def isbndb_list(collection, field, value, page):
+    "ISBNdb XML page of a collection filtered by field"
+    list_tag, data_tag, id_attr = ISBNDB_LISTS[collection]
+    if collection != 'books':
+        total = number(collection, value) % MAX_IDS
+    elif field in ('isbn', 'book_id'):
+        total = 1
+    else:
+        total = number(field, value) % MAX_BOOKS
+
+    items = []
+    for i in range((page - 1) * 10, min(page * 10, total)):
+        if collection != 'books':
+            items.append('<{0} {1}={2}><Name>{3} {4}</Name></{0}>'.format(
+                data_tag, id_attr, quoteattr('{0}_{1}'.format(value, i)),
+                value, i))
+            continue
+
+        n = number(field, value, i)
+        isbn = value if field == 'isbn' else make_isbn(n)
+        items.append(
+            '<BookData book_id="book_{0}" isbn="{1}">'
+            '<Title>Book {0}</Title><TitleLong>Book {0}, long title</TitleLong>'
+            '<AuthorsText>Author {2}, </AuthorsText>'
+            '<PublisherText publisher_id="publisher_{3}">Publisher {3}'
+            '</PublisherText><Details language="en" /></BookData>'
+            .format(n, isbn, n % 97, n % 13))
+
+    return ('<?xml version="1.0" encoding="UTF-8"?>\n<ISBNdb>'
+            '<{0} total_results="{1}" page_size="10" page_number="{2}" '
+            'shown_results="{3}">{4}</{0}></ISBNdb>'
+            .format(list_tag, total, page, len(items), ''.join(items)))
+
+
+def google_volume(isbn):
+    "Google Books volume of an isbn, a fifth of them without cover"
+    n = number('google', isbn)
+    info = {
+        'industryIdentifiers': [{'type': 'ISBN_13' if len(isbn) == 13
+                                 else 'ISBN_10', 'identifier': isbn}],
+        'pageCount': 50 + n % 900,
+        'averageRating': 1 + n % 40 / 10.0,
+        'ratingsCount': n % 200,
+    }
+    if n % 5:
+        info['imageLinks'] = {
+            'smallThumbnail': 'http://books.google.com/s/{0}'.format(isbn),
+            'thumbnail': 'http://books.google.com/t/{0}'.format(isbn),
+        }
+    return {'kind': 'books#volume', 'id': 'v' + isbn, 'volumeInfo': info}
+
+
+def amazon_items(asins):
+    "Amazon ItemLookup response with the images of half the asins"
+    items = ''.join(
+        '<Item><ASIN>{0}</ASIN>'
+        '<SmallImage><URL>http://images.amazon.com/s/{0}.jpg</URL></SmallImage>'
+        '<MediumImage><URL>http://images.amazon.com/m/{0}.jpg</URL>'
+        '</MediumImage></Item>'.format(asin)
+        for asin in asins if asin and number('amazon', asin) % 2)
+    return ('<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<ItemLookupResponse xmlns="{0}"><Items>{1}</Items>'
+            '</ItemLookupResponse>'.format(AMAZON_NS, items))
+
+
+class StandIn(object):
+    """WSGI application answering as the upstream providers
+    Requests go through a ReplayTransport, so they take the given latency
+    and fail with the given error rate
+    """
+
+    def __init__(self, path='fixtures', latency=0, error_rate=0, seed=None):
+        self.transport = ReplayTransport(path, CREDENTIALS, latency,
+                                         error_rate, synthetic, seed)
+
+    def __call__(self, environ, start_response):
+        request = Request(environ)
+        try:
+            body = self.transport.get(request.url)
+        except TransportError, err:
+            response = Response(str(err), status=err.status or 500)
+        else:
+            mimetype = 'application/json' if body[:1] == '{' else 'text/xml'
+            response = Response(body, mimetype=mimetype)
+        return response(environ, start_response)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Serves the recorded upstream responses')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8001)
+    parser.add_argument('--fixtures', default='fixtures',
+                        help='directory of the recorded responses')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='average seconds of each response')
+    parser.add_argument('--error-rate', type=float, default=0,
+                        help='part of the responses failing with a 500')
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    run_simple(args.host, args.port,
+               StandIn(args.fixtures, args.latency, args.error_rate,
+                       args.seed),
+               threaded=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -35,7 +35,69 @@ function search(search_page) {
 		// REST url to access to the resource
     var url = encodeURI('/b/' + by + '/' + query + '/' + page);
 
-    $('#results').load(url);
+    // Browsers with server-sent events get the list first and the
+    // covers and details as they arrive
+    if( window.EventSource ) {
+      url += '?progressive=1';
+    }
+
+    $('#results').load(url, listen);
     
 		return false;
 }
+
+function listen() {
+    var url = $('#book-list').data('events');
+    if( !url ) {
+      return;
+    }
+
+    if( window.events ) {
+      window.events.close();
+    }
+
+    var source = window.events = new EventSource(url);
+
+    source.addEventListener('book', function(e) {
+      update(JSON.parse(e.data));
+    }, false);
+
+    source.addEventListener('end', function(e) {
+      if( JSON.parse(e.data).partial ) {
+        $('#results .partial').show();
+      }
+      source.close();
+    }, false);
+
+    // Don't let the browser reconnect and enrich the page again
+    source.onerror = function() {
+      source.close();
+    };
+}
+
+function update(data) {
+    var book = $('li.book[data-book-id="' + data.book_id + '"]');
+    var detail = book.find('.detail');
+
+    if( data.imageLinks && data.imageLinks.thumbnail ) {
+      book.find('.cover')
+        .attr({href: data.imageLinks.thumbnail, target: '_blank'})
+        .find('img').attr('src', data.imageLinks.thumbnail);
+    }
+
+    if( data.pageCount ) {
+      detail.find('.pageCount').remove();
+      $('<div class=pageCount><strong>Pages:</strong> </div>')
+        .append(document.createTextNode(data.pageCount))
+        .insertAfter(detail.find('.isbn'));
+    }
+
+    if( data.averageRating != null && data.ratingsCount != null ) {
+      detail.find('.ratings').remove();
+      $('<div class=ratings>Rating: <span class=averageRating></span>' +
+        ' (<span class=ratingsCount></span> ratings)</div>')
+        .find('.averageRating').text(data.averageRating).end()
+        .find('.ratingsCount').text(data.ratingsCount).end()
+        .insertBefore(detail.find('.title_long, .publisher').first());
+    }
+}
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+"""
+Traces of the requests: a tree of timed spans, the slowest traces kept
+around for inspection and an optional sampling profiler.
+"""
+import sys
+import time
+import threading
+from contextlib import contextmanager
+from collections import deque, defaultdict
+
+import settings
+
+
+_local = threading.local()
+
+
+class Span(object):
+    """Timed step of a request, with the steps it started as children
+    Spans are created with span(), under the current one of the thread
+    """
+
+    def __init__(self, name, parent=None, **tags):
+        self.name = name
+        self.tags = tags
+        self.root = parent.root if parent is not None else self
+        self.start = time.time()
+        self.end = None
+        self.children = []
+        if parent is not None:
+            with self.root.lock:
+                parent.children.append(self)
+
+    @property
+    def duration(self):
+        "Seconds taken, until now if it's not finished"
+        return (self.end or time.time()) - self.start
+
+    @property
+    def offset(self):
+        "Seconds since the trace started"
+        return self.start - self.root.start
+
+    def finish(self):
+        self.end = time.time()
+
+    def walk(self, depth=0):
+        "Yields (depth, span) for this span and its descendants in order"
+        yield depth, self
+        with self.root.lock:
+            children = sorted(self.children, key=lambda span: span.start)
+        for child in children:
+            for item in child.walk(depth + 1):
+                yield item
+
+
+class Trace(Span):
+    """Root span of a request
+    Keeps the threads working on it (for the Profiler) and its profile
+    """
+
+    def __init__(self, name, **tags):
+        self.lock = threading.Lock()
+        super(Trace, self).__init__(name, **tags)
+        self.threads = defaultdict(int)  # thread id -> active spans
+        self.profile = None  # {stack: samples} if profiled
+
+    def top(self, count=20):
+        "The count profiled stacks with more samples, as (samples, stack)"
+        return sorted(((samples, stack) for stack, samples
+                       in (self.profile or {}).iteritems()),
+                      reverse=True)[:count]
+
+
+def current():
+    "The span of the current thread, None if it's not tracing"
+    return getattr(_local, 'span', None)
+
+
+@contextmanager
+def activated(span):
+    """Runs the block in the given span, the new spans are its children
+    Used to carry the span of a request to the threads working for it
+    """
+    previous = current()
+    _local.span = span
+    if span is not None:
+        ident = threading.current_thread().ident
+        with span.root.lock:
+            span.root.threads[ident] += 1
+    try:
+        yield span
+    finally:
+        _local.span = previous
+        if span is not None:
+            with span.root.lock:
+                span.root.threads[ident] -= 1
+                if not span.root.threads[ident]:
+                    del span.root.threads[ident]
+
+
+@contextmanager
+def start(name, **tags):
+    "Traces the block as a new Trace"
+    root = Trace(name, **tags)
+    try:
+        with activated(root):
+            yield root
+    finally:
+        root.finish()
+
+
+@contextmanager
+def span(name, **tags):
+    """Traces the block as a child of the current span
+    Does nothing if the thread is not tracing
+    """
+    parent = current()
+    if parent is None:
+        yield None
+        return
+
+    child = Span(name, parent, **tags)
+    try:
+        with activated(child):
+            yield child
+    except Exception, err:
+        child.tags['error'] = '{0}: {1}'.format(type(err).__name__, err)
+        raise
+    finally:
+        child.finish()
+
+
+class SlowLog(object):
+    """The last `size` traces slower than `threshold` seconds
+
+    >>> slow = SlowLog(size=50, threshold=3)
+    >>> slow.add(trace)
+    """
+
+    def __init__(self, size=50, threshold=3):
+        self.threshold = threshold
+        self.traces = deque(maxlen=size)
+        self.lock = threading.Lock()
+
+    def add(self, trace, force=False):
+        "Keeps the trace if it's slow, or anyway if force"
+        if force or trace.duration >= self.threshold:
+            with self.lock:
+                self.traces.append(trace)
+
+    def __iter__(self):
+        "Traces from the newest"
+        with self.lock:
+            return iter(list(reversed(self.traces)))
+
+
+slow = SlowLog(settings.TRACE_SLOW_SIZE, settings.TRACE_SLOW_TIME)
+
+
+class Profiler(object):
+    """Samples the stacks of the threads working on a trace every
+    `interval` seconds, counting the samples of each stack
+
+    >>> profiler = Profiler(trace, interval=0.005).start()
+    >>> ...
+    >>> profiler.stop()
+    >>> trace.profile
+    {'app.py:wsgi_app;...;api.py:get_page': 12, ...}
+    """
+
+    MAX_DEPTH = 40
+
+    def __init__(self, trace, interval=0.005):
+        self.trace = trace
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._sample, name='profiler')
+        self.thread.daemon = True
+
+    def start(self):
+        self.trace.profile = {}
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def _sample(self):
+        profile = self.trace.profile
+        while not self.stopped.wait(self.interval):
+            with self.trace.lock:
+                threads = list(self.trace.threads)
+            frames = sys._current_frames()
+            for ident in threads:
+                frame, stack = frames.get(ident), []
+                while frame is not None and len(stack) < self.MAX_DEPTH:
+                    code = frame.f_code
+                    stack.append('{0}:{1}'.format(
+                        code.co_filename.rsplit('/', 1)[-1], code.co_name))
+                    frame = frame.f_back
+                if stack:
+                    key = ';'.join(reversed(stack))
+                    profile[key] = profile.get(key, 0) + 1
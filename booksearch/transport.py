@@ -0,0 +1,443 @@
+# -*- coding: utf-8 -*-
+"""
+HTTP transport keeping persistent connections to the upstream hosts, and
+transports recording and replaying its responses for offline runs.
+"""
+import os
+import time
+import zlib
+import random
+import socket
+import urllib
+import hashlib
+import httplib
+import urlparse
+import threading
+from StringIO import StringIO
+
+
+class TransportError(Exception):
+    "Transport Exception class, status holds the HTTP status if any"
+
+    def __init__(self, message, status=None):
+        super(TransportError, self).__init__(message)
+        self.status = status
+
+
+class TransportTimeout(TransportError):
+    "Raised when the socket timed out"
+    pass
+
+
+class Cancel(object):
+    """Lets another thread abort a call in progress by shutting down its
+    connection, the call then fails with TransportError
+
+    >>> cancel = Cancel()
+    >>> transport.get(url, cancel=cancel)  # while elsewhere
+    >>> cancel.cancel()
+    """
+
+    def __init__(self):
+        self.cancelled = False
+        self.conn = None
+        self.lock = threading.Lock()
+
+    def cancel(self):
+        with self.lock:
+            self.cancelled = True
+            if self.conn is not None and self.conn.sock is not None:
+                try:
+                    self.conn.sock.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+
+    def attach(self, conn):
+        "Sets the connection of the call, raises TransportError if cancelled"
+        with self.lock:
+            if self.cancelled:
+                raise TransportError('Cancelled')
+            self.conn = conn
+
+    def detach(self):
+        "Call over, returns whether its connection can be reused"
+        with self.lock:
+            self.conn = None
+            return not self.cancelled
+
+
+def create_transport(kind, size, sizes=None, ignore=(), **options):
+    """Returns a transport of the given kind ('http', 'record' or 'replay')
+    initialized with options
+    size and sizes are the connection pool sizes of the http transports,
+    ignore the url parameters left out of the fixture names
+    """
+    if kind == 'http':
+        return HTTPTransport(size, sizes, **options)
+    if kind == 'record':
+        return RecordingTransport(size, sizes, ignore=ignore, **options)
+    if kind == 'replay':
+        if options.pop('synthetic', False):
+            import standin
+            options['fallback'] = standin.synthetic
+        return ReplayTransport(ignore=ignore, **options)
+    raise ValueError("Unknown transport '{0}'".format(kind))
+
+
+class ConnectionPool(object):
+    """Keep-alive connections to a single host
+    At most `size` idle connections are kept around to be reused
+    """
+
+    def __init__(self, scheme, host, size):
+        if scheme == 'https':
+            self.connection_class = httplib.HTTPSConnection
+        else:
+            self.connection_class = httplib.HTTPConnection
+        self.host = host
+        self.size = size
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        "Returns (connection, reused) taking an idle one if possible"
+        with self.lock:
+            if self.idle:
+                return self.idle.pop(), True
+        return self.connection_class(self.host), False
+
+    def release(self, conn):
+        "Gives back a connection whose response has been fully read"
+        with self.lock:
+            if len(self.idle) < self.size:
+                self.idle.append(conn)
+                return
+        conn.close()
+
+
+class HTTPTransport(object):
+    """Performs GET requests over pooled keep-alive connections
+    One ConnectionPool is kept per host and gzip/deflate bodies are decoded
+
+    >>> HTTPTransport(size=4).get('http://isbndb.com/api/books.xml?...')
+    '<?xml version="1.0" encoding="UTF-8"?>...'
+    """
+
+    HEADERS = {
+        'Accept-Encoding': 'gzip, deflate',
+        'Connection': 'keep-alive',
+        'User-Agent': 'booksearch',
+    }
+    MAX_REDIRECTS = 3
+
+    def __init__(self, size, sizes=None, upstream=None):
+        """size idle connections are kept per host unless set in sizes
+        upstream replaces the scheme and host of every url, to send all the
+        calls to a stand-in server (see standin.py)
+        """
+        self.size = size
+        self.sizes = sizes or {}
+        self.upstream = urlparse.urlsplit(upstream) if upstream else None
+        self.pools = {}
+        self.lock = threading.Lock()
+
+    def get(self, url, timeout=None, cancel=None):
+        """Fetchs url and returns the decoded body
+        timeout is the number of seconds to wait for each socket operation,
+        cancel a Cancel to abort it from another thread
+        raises TransportError on network errors or HTTP error statuses
+        """
+        stream = self.stream(url, timeout, cancel)
+        try:
+            return stream.read()
+        finally:
+            stream.close()
+
+    def stream(self, url, timeout=None, cancel=None):
+        """Fetchs url and returns a StreamResponse, a file-like object to
+        read the decoded body while it's being downloaded. It must be closed
+        raises TransportError on network errors or HTTP error statuses
+        """
+        for _ in range(self.MAX_REDIRECTS + 1):
+            pool, conn, response = self._request(url, timeout, cancel)
+            stream = StreamResponse(pool, conn, response, cancel)
+            if response.status in (301, 302, 303, 307):
+                stream.close()
+                url = urlparse.urljoin(url, response.getheader('location'))
+                continue
+            if response.status >= 400:
+                stream.close()
+                raise TransportError('HTTP Error {0}: {1}'
+                                     .format(response.status, response.reason),
+                                     status=response.status)
+            return stream
+
+        raise TransportError('Too many redirects: {0}'.format(url))
+
+    def _pool(self, scheme, host):
+        "Returns the connection pool for host"
+        with self.lock:
+            key = (scheme, host)
+            if key not in self.pools:
+                size = self.sizes.get(host, self.size)
+                self.pools[key] = ConnectionPool(scheme, host, size)
+            return self.pools[key]
+
+    def _request(self, url, timeout=None, cancel=None):
+        """Sends the GET request and returns (pool, connection, response)
+        once the response headers have been read
+        A reused connection may have been dropped by the server meanwhile,
+        in that case the request is retried once on a new connection
+        """
+        parts = urlparse.urlsplit(url)
+        if self.upstream:
+            parts = parts._replace(scheme=self.upstream.scheme,
+                                   netloc=self.upstream.netloc)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        pool = self._pool(parts.scheme, parts.netloc)
+
+        while True:
+            conn, reused = pool.acquire()
+            conn.timeout = timeout
+            if conn.sock is not None:
+                conn.sock.settimeout(timeout)
+            try:
+                if cancel is not None:
+                    if conn.sock is None:
+                        conn.connect()
+                    cancel.attach(conn)
+                conn.request('GET', path, headers=self.HEADERS)
+                return pool, conn, conn.getresponse()
+            except TransportError:
+                conn.close()
+                raise
+            except (httplib.HTTPException, socket.error), err:
+                conn.close()
+                if cancel is not None and not cancel.detach():
+                    raise TransportError('Cancelled')
+                if isinstance(err, socket.timeout):
+                    raise TransportTimeout(err)
+                if reused:
+                    continue
+                raise TransportError(err)
+
+
+class StreamResponse(object):
+    """File-like body of a response, decompressed on the fly
+    The connection goes back to its pool once the body is fully read
+    """
+
+    CHUNK_SIZE = 16 * 1024
+
+    def __init__(self, pool, conn, response, cancel=None):
+        self.pool = pool
+        self.conn = conn
+        self.response = response
+        self.cancel = cancel
+        self.finished = False
+
+        encoding = (response.getheader('content-encoding') or '').lower()
+        if encoding == 'gzip':
+            self.decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif encoding == 'deflate':
+            self.decoder = None  # zlib or raw, known on the first chunk
+        else:
+            self.decoder = False
+
+    def read(self, size=-1):
+        """Reads up to size decoded bytes, all the body if size < 0
+        Returns an empty string at the end of the body
+        """
+        if size < 0:
+            return ''.join(iter(lambda: self.read(self.CHUNK_SIZE), ''))
+
+        while not self.finished:
+            try:
+                raw = self.response.read(size)
+            except (httplib.HTTPException, socket.error), err:
+                self.close()
+                if isinstance(err, socket.timeout):
+                    raise TransportTimeout(err)
+                raise TransportError(err)
+
+            if not raw:
+                data = self.decoder.flush() if self.decoder else ''
+                self._finish()
+                return data
+
+            data = self._decode(raw)
+            if data:
+                return data
+
+        return ''
+
+    def close(self):
+        "Closes the connection unless the body was fully read"
+        if not self.finished:
+            self.finished = True
+            if self.cancel is not None:
+                self.cancel.detach()
+            self.conn.close()
+
+    def _decode(self, raw):
+        "Decompress a chunk according to the Content-Encoding"
+        if self.decoder is None:
+            # Deflate bodies should be zlib streams, but some servers send
+            # raw deflate streams without headers
+            zlib_header = (len(raw) > 1 and ord(raw[0]) & 0x0f == 8 and
+                           (ord(raw[0]) << 8 | ord(raw[1])) % 31 == 0)
+            self.decoder = zlib.decompressobj(zlib.MAX_WBITS if zlib_header
+                                              else -zlib.MAX_WBITS)
+        if not self.decoder:
+            return raw
+        try:
+            return self.decoder.decompress(raw)
+        except zlib.error, err:
+            self.close()
+            raise TransportError(err)
+
+    def _finish(self):
+        self.finished = True
+        reusable = self.cancel is None or self.cancel.detach()
+        if self.response.will_close or not reusable:
+            self.conn.close()
+        else:
+            self.pool.release(self.conn)
+        if not reusable:  # the body may be cut short
+            raise TransportError('Cancelled')
+
+
+class FixtureStore(object):
+    """Responses saved as files in a directory, one per url
+
+    Files are named after a hash of the url path and query, so the same
+    fixtures answer whatever the upstream host is. The parameters in
+    `ignore` (credentials, timestamps, signatures) are left out of it.
+    Each file holds the url and the HTTP status in its first two lines and
+    the body after them.
+
+    >>> store = FixtureStore('fixtures', ignore=('access_key',))
+    >>> store.save('http://isbndb.com/api/books.xml?...', 200, '<?xml...')
+    >>> store.load('http://localhost:8000/api/books.xml?...')
+    (200, '<?xml...')
+    """
+
+    def __init__(self, path, ignore=()):
+        self.path = path
+        self.ignore = frozenset(ignore)
+
+    def key(self, url):
+        "Hash of the url path and its query, sorted and without ignored"
+        parts = urlparse.urlsplit(url)
+        query = sorted((k, v) for k, v in urlparse.parse_qsl(parts.query, True)
+                       if k not in self.ignore)
+        return hashlib.sha1(parts.path + '?' + urllib.urlencode(query))\
+                      .hexdigest()
+
+    def load(self, url):
+        "Returns the saved (status, body) of url, None if there's none"
+        try:
+            with open(os.path.join(self.path, self.key(url)), 'rb') as stored:
+                stored.readline()
+                return int(stored.readline()), stored.read()
+        except IOError:
+            return None
+
+    def save(self, url, status, body):
+        "Saves the response of url, replacing the previous one"
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        name = os.path.join(self.path, self.key(url))
+        with open(name + '.tmp', 'wb') as stored:
+            stored.write('{0}\n{1}\n'.format(url, status))
+            stored.write(body)
+        os.rename(name + '.tmp', name)
+
+
+class RecordingTransport(HTTPTransport):
+    """HTTPTransport saving every response in a FixtureStore
+    Streamed bodies are downloaded whole to be saved before they're read
+
+    >>> RecordingTransport(size=4, path='fixtures').get('http://...')
+    """
+
+    def __init__(self, size, sizes=None, path='fixtures', ignore=(),
+                 upstream=None):
+        super(RecordingTransport, self).__init__(size, sizes, upstream)
+        self.store = FixtureStore(path, ignore)
+
+    def stream(self, url, timeout=None, cancel=None):
+        try:
+            response = super(RecordingTransport, self).stream(url, timeout,
+                                                              cancel)
+        except TransportError, err:
+            if err.status is not None:
+                self.store.save(url, err.status, '')
+            raise
+        try:
+            body = response.read()
+        finally:
+            response.close()
+        self.store.save(url, 200, body)
+        return StringIO(body)
+
+
+class ReplayTransport(object):
+    """Answers with the responses saved by a RecordingTransport
+
+    Calls take `latency` seconds on average (exponentially distributed, so
+    there's a tail of slow ones) and fail with an HTTP 500 `error_rate`
+    times, to reproduce the conditions of a real provider. Urls without a
+    fixture are answered by fallback(url), which returns (status, body),
+    or fail with an HTTP 404. seed makes the latency and errors repeatable
+
+    >>> transport = ReplayTransport('fixtures', latency=0.1, error_rate=0.01)
+    >>> transport.get('http://isbndb.com/api/books.xml?...')
+    '<?xml version="1.0" encoding="UTF-8"?>...'
+    """
+
+    def __init__(self, path='fixtures', ignore=(), latency=0, error_rate=0,
+                 fallback=None, seed=None):
+        self.store = FixtureStore(path, ignore)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.fallback = fallback
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def get(self, url, timeout=None, cancel=None):
+        "Returns the saved body of url, see HTTPTransport.get"
+        return self.stream(url, timeout, cancel).read()
+
+    def stream(self, url, timeout=None, cancel=None):
+        """Returns the saved body of url as a file-like object
+        A cancelled call fails once its latency has passed
+        """
+        with self.lock:
+            delay = (self.random.expovariate(1.0 / self.latency)
+                     if self.latency else 0)
+            failed = self.random.random() < self.error_rate
+
+        if timeout is not None and delay > timeout:
+            time.sleep(timeout)
+            raise TransportTimeout('timed out')
+        time.sleep(delay)
+        if cancel is not None and cancel.cancelled:
+            raise TransportError('Cancelled')
+        if failed:
+            raise TransportError('HTTP Error 500: Injected error', status=500)
+
+        response = self.store.load(url)
+        if response is None and self.fallback is not None:
+            response = self.fallback(url)
+        if response is None:
+            raise TransportError('HTTP Error 404: No fixture for {0}'
+                                 .format(url), status=404)
+
+        status, body = response
+        if status >= 400:
+            raise TransportError('HTTP Error {0}: Replayed'.format(status),
+                                 status=status)
+        return StringIO(body)